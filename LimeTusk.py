@@ -22,37 +22,146 @@ import sys
 from limetusk import util
 from limetusk.book import Book, BookOptions
 from limetusk.book_builder import BookBuilder
+from limetusk.cache import ArtifactCache
+from limetusk.server import BuildServer, default_socket_path, request_build
+from limetusk.split_builder import SplitBookBuilder
+from limetusk.trace import tracer
+from limetusk.variant_builder import VariantBookBuilder
+from limetusk.watch import BookWatcher
 
 
-def parse_cmd_options():
+def parse_cmd_options(args=None):
     parser = argparse.ArgumentParser(description='Create modular and beautfiul songbooks using LilyPond and LaTeX.')
     parser.add_argument(      '--version',                  action='version',                               version='%(prog)s ' + __version__)
     parser.add_argument('-v', '--verbose', dest='verbose',  action='count'     , default=0, required=False, help="Enable verbose building process.")
-    parser.add_argument('-d', '--draft',   dest='draft',    action='store_true',            required=False, help="Generate document in draft mode, to speed up testing.")
+    parser.add_argument('-d', '--draft',   dest='draft',    action='store_true',            required=False, help="Generate a quick layout preview without rendering the songs.")
     parser.add_argument(      '--in',      dest='in_path',  action='store',                 required=True,  help="Path to the book to compile.")
     parser.add_argument(      '--out',     dest='out_path', action='store',                 required=True,  help="Path of the output directory. Will create dir if necesarry.")
     parser.add_argument(      '--midi',    dest='midi',     action='store_true',            required=False, help="Generate midi files for songs and attach them in the output file. Note: attachments in pdfs aren't very well supported by many viewers.")
-    cmd_options = parser.parse_args()
-    return BookOptions(cmd_options.in_path, cmd_options.out_path, cmd_options.midi, cmd_options.draft, cmd_options.verbose)
+    parser.add_argument('-j', '--jobs',    dest='jobs',     action='store', type=int,       required=False, help="Number of parallel conversion processes. Defaults to the number of CPUs.")
+    parser.add_argument(      '--no-cache',    dest='cache',       action='store_false',    required=False, help="Don't use or update the conversion and element caches.")
+    parser.add_argument(      '--clear-cache', dest='clear_cache', action='store_true',     required=False, help="Clear the conversion and element caches before building.")
+    parser.add_argument(      '--watch',       dest='watch',       action='store_true',     required=False, help="Keep running and rebuild the book whenever one of its files changes.")
+    parser.add_argument(      '--max-passes',  dest='max_passes',  action='store', type=int, default=4, required=False, help="Maximum number of pdflatex passes, including the draft pass. Defaults to 4.")
+    parser.add_argument(      '--split',       dest='split',       action='store_true',     required=False, help="Compile every chapter as its own document in parallel and merge them. Needs pypdf.")
+    parser.add_argument(      '--recheck-env', dest='recheck_env', action='store_true',     required=False, help="Probe all external tools again instead of trusting the cached toolchain state.")
+    parser.add_argument(      '--trace',       dest='trace',       action='store', metavar='OUT_JSON', required=False, help="Trace the build and write it in the Chrome trace event format. A summary of the slowest steps is logged.")
+    parser.add_argument(      '--dpi',         dest='dpi',         action='store', type=int, required=False, help="Downsample pictures to this resolution, e.g. 150 for a screen and 300 for a print edition. Needs Pillow.")
+    parser.add_argument(      '--only',        dest='only',        action='append', metavar='FILTER', required=False, help="Only build part of the book, can be repeated: chapter:PATTERN, an element keyword like csong, or a song title pattern.")
+    parser.add_argument(      '--engine',      dest='engine',      action='store', choices=['lilypond-book', 'lilypond'], default='lilypond-book', required=False, help="Render the songs with lilypond-book, or with lilypond directly in parallel. Defaults to lilypond-book.")
+    parser.add_argument(      '--cache-dir',   dest='cache_dir',   action='store',          required=False, help="Directory of an artifact cache shared by all books, which also holds their element cache. Manage it with 'LimeTusk.py cache stats|prune'.")
+    parser.add_argument(      '--cache-limit', dest='cache_limit', action='store', type=int, default=2048, required=False, help="Size limit of the shared cache in MiB, least recently used artifacts are evicted. Defaults to 2048.")
+    parser.add_argument(      '--max-jvms',    dest='max_jvms',    action='store', type=int, required=False, help="Maximum number of tg2ly JVMs running at the same time. Defaults to --jobs.")
+    parser.add_argument(      '--max-memory',  dest='max_memory',  action='store', type=int, required=False, help="Memory in MiB the external tools may use at the same time, estimated per process. Defaults to half of the physical memory.")
+    parser.add_argument(      '--paper',       dest='paper',       action='store', choices=['a4', 'a5'], default='a4', required=False, help="Paper size of the book. Defaults to a4.")
+    parser.add_argument(      '--variant',     dest='variants',    action='append', metavar='NAME[:SETTING,...]', required=False, help="Build a variant of the book named TITLE-NAME, can be repeated. Songs are prepared once for all variants. Settings are midi, no-midi, draft, a4 and a5, the others are taken from the command line, e.g. --variant print:midi --variant proof:draft,a5.")
+    cmd_options = parser.parse_args(args)
+    if cmd_options.variants and cmd_options.split:
+        parser.error("--variant can't be combined with --split.")
+    if cmd_options.jobs is not None and cmd_options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if cmd_options.max_passes < 1:
+        parser.error("--max-passes must be at least 1.")
+    try:
+        return BookOptions(**vars(cmd_options))
+    except ValueError as e:
+        parser.error(str(e))
+
+def cache_command(args):
+    parser = argparse.ArgumentParser(prog='LimeTusk.py cache', description='Manage the artifact cache shared by all books.')
+    parser.add_argument(      'command',                    choices=['stats', 'prune'],                    help="Show statistics, or evict least recently used artifacts down to the size limit.")
+    parser.add_argument(      '--cache-dir',   dest='cache_dir',   action='store',          required=True,  help="Directory of the shared cache.")
+    parser.add_argument(      '--cache-limit', dest='cache_limit', action='store', type=int, default=2048, required=False, help="Size limit in MiB for prune. Defaults to 2048, 0 empties the cache.")
+    cmd_options = parser.parse_args(args)
+
+    cache = ArtifactCache(cmd_options.cache_dir, cmd_options.cache_limit << 20)
+    if cmd_options.command == "prune":
+        cache.prune(cache.max_size)
+    stats = cache.stats()
+    print("Cache directory: {path}".format(path=stats["path"]))
+    print("Entries:         {entries}".format(entries=stats["entries"]))
+    print("Size:            {size:.1f} MiB of {max_size:.1f} MiB".format(size=stats["size"] / (1 << 20),
+                                                                          max_size=stats["max_size"] / (1 << 20)))
+    if stats["oldest"] is not None:
+        print("Oldest use:      {oldest}".format(oldest=time.strftime("%Y-%m-%d %H:%M", time.localtime(stats["oldest"]))))
+    print("Hits / misses:   {hits} / {misses}".format(hits=stats["hits"], misses=stats["misses"]))
+
+
+def serve_command(args):
+    parser = argparse.ArgumentParser(prog='LimeTusk.py serve', description='Run a build server, which keeps the toolchain state and parsed books in memory between builds.')
+    parser.add_argument(      '--socket',      dest='socket_path', action='store', default=default_socket_path(), required=False, help="Path of the Unix socket to listen on. Defaults to " + default_socket_path() + ".")
+    parser.add_argument(      '--max-books',   dest='max_books',   action='store', type=int, default=8, required=False, help="Number of books kept in memory. Defaults to 8.")
+    parser.add_argument(      '--max-workers', dest='max_workers', action='store', type=int, default=2, required=False, help="Number of tg2ly JVMs kept running between builds. Defaults to 2.")
+    cmd_options = parser.parse_args(args)
+
+    try:
+        BuildServer(cmd_options.socket_path, parse_cmd_options, create_builder, cmd_options.max_books,
+                    cmd_options.max_workers).run()
+    except (FileNotFoundError, FileExistsError) as e:
+        sys.exit(e)
+
+
+def client_command(args):
+    parser = argparse.ArgumentParser(prog='LimeTusk.py client', description='Build a book with a running build server. All other arguments are passed on like those of a regular build.')
+    parser.add_argument(      '--socket',      dest='socket_path', action='store', default=default_socket_path(), required=False, help="Path of the build server's Unix socket. Defaults to " + default_socket_path() + ".")
+    cmd_options, build_args = parser.parse_known_args(args)
+
+    try:
+        ok = request_build(cmd_options.socket_path, build_args)
+    except ConnectionError as e:
+        sys.exit(e)
+    sys.exit(0 if ok else 1)
+
+
+def create_builder(book, options):
+    """The builder for the options. Raises FileNotFoundError, if it needs a
+    missing module.
+    """
+    if options.split:
+        SplitBookBuilder.check_env()
+        return SplitBookBuilder(book, options)
+    elif options.variants:
+        return VariantBookBuilder(book, options)
+    return BookBuilder(book, options)
+
 
 def main():
+    if sys.argv[1:2] == ["cache"]:
+        return cache_command(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        return serve_command(sys.argv[2:])
+    if sys.argv[1:2] == ["client"]:
+        return client_command(sys.argv[2:])
     options = parse_cmd_options()
 
     if options.verbose:
         log_level = logging.DEBUG
+    if options.trace:
+        tracer.enabled = True
     run_time = time.time()
 
     try:
-        util.check_env()
+        util.check_env(options.recheck_env)
+        # the book is parsed by the builder, so songs are converted while parsing
+        book = Book(options.in_path, options, parse=False)
+        builder = create_builder(book, options)
     except FileNotFoundError as e:
         sys.exit(e)
-
-    logging.info("Parsing book and converting songs...")
-    book = Book(options.in_path, options)
-    builder = BookBuilder(book, options)
-    builder.build()
+    ok = builder.build()
     
-    logging.info("Finished in {run_time:.2f} seconds".format(run_time=(time.time() - run_time)))
+    if ok:
+        logging.info("Finished in {run_time:.2f} seconds".format(run_time=(time.time() - run_time)))
+    else:
+        logging.error("Build failed after {run_time:.2f} seconds".format(run_time=(time.time() - run_time)))
+
+    if options.trace:
+        tracer.write(options.trace)
+        logging.info(tracer.summary())
+
+    if options.watch:
+        BookWatcher(book, builder).run()
+    elif not ok:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+"""Benchmark LimeTusk builds with synthetic books.
+
+Generates a book with the given number of songs, chord sheets, quotes and
+pictures and builds it twice: once cold into an empty output directory and
+once warm into the same directory again. By default the external tools are
+replaced by the stand-ins in benchmarks/stubs, which only copy files and sleep
+for the configured delays, so the benchmark runs without java, LilyPond or
+LaTeX. Use --real to benchmark the installed toolchain instead.
+
+Example:
+    benchmarks/bench.py --songs 100 --csongs 500 --save-baseline base.json
+    benchmarks/bench.py --songs 100 --csongs 500 --compare base.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_PATH = os.path.join(REPO_PATH, "benchmarks", "stubs")
+sys.path.insert(0, REPO_PATH)
+
+from limetusk import util
+from limetusk.book import Book, BookOptions
+from limetusk.book_builder import BookBuilder
+
+CHORDS = ["A", "Am", "A7", "B", "Bm", "C", "C7", "D", "Dm", "D7", "E", "Em", "E7", "F", "G", "G7"]
+WORDS  = ("lorem ipsum dolor sit amet consetetur sadipscing elitr sed diam nonumy eirmod tempor "
+          "invidunt ut labore et dolore magna aliquyam erat voluptua at vero eos accusam justo duo "
+          "dolores ea rebum stet clita kasd gubergren no sea takimata sanctus est").split()
+
+# name of the stage, object the method belongs to ("book" or "builder"), method
+# conversion, midi and rendering overlap, they are timed together as prepare
+STAGES = [("prepare",       "builder", "prepare"),
+          ("lytex",         "builder", "generate_lytex"),
+          ("lilypond-book", "builder", "generate_tex"),
+          ("pdflatex",      "builder", "compile_passes")]
+
+
+def chord_sheet(rnd):
+    ret = ""
+    for begin, end in [("\\beginverse*", "\\endverse"), ("\\beginchorus", "\\endchorus")] * 2:
+        ret += begin + "\n"
+        for _ in range(4):
+            words = [rnd.choice(WORDS) for _ in range(rnd.randint(8, 14))]
+            for i in range(0, len(words), 4):
+                words[i] = "\\[" + rnd.choice(CHORDS) + "]" + words[i]
+            ret += "    " + " ".join(words) + "\n"
+        ret += end + "\n"
+    return ret
+
+
+def generate_book(path, songs, csongs, quotes, pics, seed):
+    """Write a synthetic book with the given number of elements to path and
+    return the path of the .book file.
+    """
+    rnd = random.Random(seed)
+    for sub_dir in ["songs", "quotes", "pics", "res"]:
+        os.makedirs(os.path.join(path, sub_dir), exist_ok=True)
+    shutil.copy(os.path.join(REPO_PATH, "input_example", "res", "pics", "example.png"), os.path.join(path, "res"))
+
+    elements = []
+    for i in range(songs):
+        with open(os.path.join(path, "res", "song{:05d}.tg".format(i)), "wb") as fd:
+            fd.write(bytes(rnd.getrandbits(8) for _ in range(2048)))
+        with open(os.path.join(path, "songs", "song{:05d}.song".format(i)), "w") as fd:
+            fd.write(repr({"artist": "Artist {}".format(i % 37), "title": "Song {}".format(i), "album": "",
+                           "tuning": "Tuning: EAdgbe'", "composer": "", "tg_file": "res/song{:05d}.tg".format(i)}))
+        elements.append("song:songs/song{:05d}.song".format(i))
+    for i in range(csongs):
+        with open(os.path.join(path, "songs", "csong{:05d}.csong".format(i)), "w") as fd:
+            fd.write(repr({"artist": "Artist {}".format(i % 53), "title": "Chord Sheet {}".format(i), "year": "",
+                           "album": "", "tuning": "", "composer": "", "content": chord_sheet(rnd)}))
+        elements.append("csong:songs/csong{:05d}.csong".format(i))
+    for i in range(quotes):
+        with open(os.path.join(path, "quotes", "quote{:05d}.quote".format(i)), "w") as fd:
+            fd.write(repr({"source": "Source {}".format(i), "text": " ".join(rnd.choice(WORDS) for _ in range(20))}))
+        elements.append("quote:quotes/quote{:05d}.quote".format(i))
+    for i in range(pics):
+        with open(os.path.join(path, "pics", "pic{:05d}.pic".format(i)), "w") as fd:
+            fd.write(repr({"align": "center", "size": r"width=0.6\textwidth", "pic_path": "res/example.png"}))
+        elements.append("pic:pics/pic{:05d}.pic".format(i))
+    rnd.shuffle(elements)
+
+    book_path = os.path.join(path, "bench.book")
+    with open(book_path, "w") as fd:
+        fd.write("title:Benchmark\n")
+        for i, element in enumerate(elements):
+            if i % 25 == 0:
+                fd.write("chapter:Chapter {}\n".format(i // 25 + 1))
+            fd.write("    " + element + "\n")
+    return book_path
+
+
+def timed(timings, name, func):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+    return wrapper
+
+
+def run_build(book_path, options):
+    """Build the book once. Returns the time spent in every stage and the
+    peak memory allocated by Python during the build.
+    """
+    timings = {}
+    tracemalloc.start()
+    start = time.perf_counter()
+    book = timed(timings, "parse", Book)(book_path, options)
+    builder = BookBuilder(book, options)
+    objects = {"book": book, "builder": builder}
+    for name, obj, method in STAGES:
+        setattr(objects[obj], method, timed(timings, name, getattr(objects[obj], method)))
+    builder.build()
+    timings["total"] = time.perf_counter() - start
+    timings["peak_memory"] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return timings
+
+
+def compare(results, baseline, tolerance):
+    """Print the results next to the baseline. Returns True, if a stage got
+    slower than the tolerance allows.
+    """
+    regression = False
+    for run, timings in results["runs"].items():
+        for name, value in timings.items():
+            old = baseline["runs"].get(run, {}).get(name)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            # ignore noise on very short stages
+            slower = change > tolerance and (name == "peak_memory" or value - old > 0.05)
+            regression = regression or slower
+            print("{run:5} {name:14} {old:12.3f} {new:12.3f} {change:+8.1%}{flag}".format(
+                run=run, name=name, old=old, new=value, change=change, flag="  REGRESSION" if slower else ""))
+    return regression
+
+
+def parse_cmd_options():
+    parser = argparse.ArgumentParser(description="Benchmark LimeTusk builds with synthetic books.")
+    parser.add_argument("--songs",   type=int, default=50,  help="Number of tablature songs.")
+    parser.add_argument("--csongs",  type=int, default=200, help="Number of chord sheets.")
+    parser.add_argument("--quotes",  type=int, default=20,  help="Number of quotes.")
+    parser.add_argument("--pics",    type=int, default=10,  help="Number of pictures.")
+    parser.add_argument("--seed",    type=int, default=0,   help="Seed of the generated content.")
+    parser.add_argument("--midi",    action="store_true",   help="Render midi files.")
+    parser.add_argument("--jobs",    type=int, default=None, help="Number of parallel processes.")
+    parser.add_argument("--engine",  default="lilypond-book", choices=["lilypond-book", "lilypond"], help="Engine rendering the songs.")
+    parser.add_argument("--repeat",  type=int, default=1,   help="Repeat the benchmark and keep the fastest times.")
+    parser.add_argument("--java-delay",          type=float, default=0.2,  help="Seconds the tg2ly stand-in sleeps per song.")
+    parser.add_argument("--lilypond-delay",      type=float, default=0.1,  help="Seconds the lilypond stand-in sleeps per midi file.")
+    parser.add_argument("--lilypond-book-delay", type=float, default=0.02, help="Seconds the lilypond-book stand-in sleeps per snippet.")
+    parser.add_argument("--pdflatex-delay",      type=float, default=0.5,  help="Seconds the pdflatex stand-in sleeps per 100 kB of tex.")
+    parser.add_argument("--real",    action="store_true",   help="Use the installed toolchain instead of the stand-ins.")
+    parser.add_argument("--keep",    action="store_true",   help="Keep the generated book and output directory.")
+    parser.add_argument("--save-baseline", metavar="PATH",  help="Save the results as baseline.")
+    parser.add_argument("--compare",       metavar="PATH",  help="Compare the results to a saved baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown compared to the baseline. Defaults to 0.2.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_cmd_options()
+    logging.getLogger().setLevel(logging.WARNING)
+    # tool and jar paths are relative to the repository
+    os.chdir(REPO_PATH)
+
+    work_path = tempfile.mkdtemp(prefix="limetusk-bench-")
+    util.ENV_STATE_PATH = os.path.join(work_path, "env.json")
+    if not args.real:
+        os.environ["PATH"] = STUB_PATH + os.pathsep + os.environ["PATH"]
+        os.environ["LIMETUSK_STUB_JAVA_DELAY"]          = str(args.java_delay)
+        os.environ["LIMETUSK_STUB_LILYPOND_DELAY"]      = str(args.lilypond_delay)
+        os.environ["LIMETUSK_STUB_LILYPOND_BOOK_DELAY"] = str(args.lilypond_book_delay)
+        os.environ["LIMETUSK_STUB_PDFLATEX_DELAY"]      = str(args.pdflatex_delay)
+    try:
+        util.check_env()
+    except FileNotFoundError as e:
+        sys.exit(e)
+
+    params = {k: v for k, v in vars(args).items() if k not in ["keep", "save_baseline", "compare", "tolerance"]}
+    results = {"params": params, "runs": {}}
+    try:
+        book_path = generate_book(os.path.join(work_path, "book"), args.songs, args.csongs, args.quotes, args.pics, args.seed)
+        for _ in range(args.repeat):
+            out_path = os.path.join(work_path, "out")
+            shutil.rmtree(out_path, ignore_errors=True)
+            options = BookOptions(book_path, out_path, midi=args.midi, jobs=args.jobs, engine=args.engine)
+            for run in ["cold", "warm"]:
+                timings = run_build(book_path, options)
+                best = results["runs"].setdefault(run, timings)
+                for name, value in timings.items():
+                    best[name] = min(best[name], value) if name in best else value
+    finally:
+        if args.keep:
+            print("Kept book and output in " + work_path)
+        else:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    for run, timings in results["runs"].items():
+        for name, value in timings.items():
+            if name == "peak_memory":
+                print("{run:5} {name:14} {value:12.1f} MiB".format(run=run, name=name, value=value / (1 << 20)))
+            else:
+                print("{run:5} {name:14} {value:12.3f} s".format(run=run, name=name, value=value))
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("max resident size of the benchmark process: {max_rss:.1f} MiB".format(max_rss=max_rss))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fd:
+            json.dump(results, fd, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "r") as fd:
+            baseline = json.load(fd)
+        if baseline["params"] != params:
+            logging.warning("Baseline was recorded with different parameters.")
+        print("\nCompared to " + args.compare + ":")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
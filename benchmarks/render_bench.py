@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+"""Micro-benchmark of rendering the lytex fragments of book elements.
+
+Renders the song and chord sheet templates for synthetic metadata three
+ways and prints the time per fragment:
+
+    legacy     escaping character by character and str.format, like the
+               elements did before limetusk.render
+    template   Template.render with the precompiled escaping
+    memoized   BookElement.render for elements rendered before with the
+               same values, like on rebuilds in watch mode or by the server.
+               Chord sheets have a lazy key and are not memoized.
+
+All three have to produce the same fragments.
+
+Example:
+    benchmarks/render_bench.py --count 5000 --repeat 5
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from bench import WORDS, chord_sheet
+from limetusk.elements import BookElement, CSong, Song
+
+
+def legacy_escape_latex(s):
+    _latex_special_chars = {
+        '&':  r'\&',
+        '%':  r'\%',
+        '$':  r'\$',
+        '#':  r'\#',
+        '_':  r'\_',
+        '{':  r'\{',
+        '}':  r'\}',
+        '~':  r'\textasciitilde{}',
+        '^':  r'\^{}',
+        '\\': r'\textbackslash{}',
+        '\n': r'\\',
+        '-':  r'{-}',
+        '\xA0': '~',  # Non-breaking space
+    }
+    return ''.join(_latex_special_chars.get(c, c) for c in s)
+
+
+def legacy_render(template, values):
+    return template.text.format(**{name: legacy_escape_latex(value) if name in template.escaped else value
+                                   for name, value in values.items()})
+
+
+def phrase(rnd, low, high):
+    ret = " ".join(rnd.choice(WORDS).capitalize() for _ in range(rnd.randint(low, high)))
+    # some titles contain special characters
+    return ret + rnd.choice(["", "", "", " - Live", " & Friends", " (50% Remix)"])
+
+
+def generate_values(count, seed):
+    """Values of count songs and count chord sheets."""
+    rnd = random.Random(seed)
+    ret = []
+    for i in range(count):
+        ret.append((Song.str_template, {"artist":    phrase(rnd, 1, 3),
+                                        "title":     phrase(rnd, 1, 5),
+                                        "tuning":    "Tuning: EAdgbe'",
+                                        "album":     phrase(rnd, 0, 3),
+                                        "composer":  phrase(rnd, 0, 2),
+                                        "midi_file": "out/{:032x}.midi".format(rnd.getrandbits(128)),
+                                        "score":     "\\lilypondfile{{out/{:032x}.ly}}".format(rnd.getrandbits(128))}))
+        ret.append((CSong.str_template, {"artist":   phrase(rnd, 1, 3),
+                                         "title":    phrase(rnd, 1, 5),
+                                         "tuning":   "",
+                                         "composer": phrase(rnd, 0, 2),
+                                         "content":  chord_sheet(rnd)}))
+    return ret
+
+
+def measure(func, items, repeat):
+    """Best time of repeat runs of func over all items and its results."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [func(template, values) for template, values in items]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def parse_cmd_options():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of rendering the lytex fragments of book elements.")
+    parser.add_argument("--count",  type=int, default=2000, help="Number of songs and of chord sheets.")
+    parser.add_argument("--repeat", type=int, default=5,    help="Repeat the benchmark and keep the fastest times.")
+    parser.add_argument("--seed",   type=int, default=0,    help="Seed of the generated metadata.")
+    return parser.parse_args()
+
+
+def main():
+    args  = parse_cmd_options()
+    items = generate_values(args.count, args.seed)
+
+    # stand-ins for the elements, which would need files
+    elements = [types.SimpleNamespace(lazy=Song.lazy if template is Song.str_template else CSong.lazy, fragments={})
+                for template, _ in items]
+    for element, (template, values) in zip(elements, items):
+        BookElement.render(element, template, **values)
+    memoized = iter(elements * args.repeat)
+
+    runs = [("legacy",   legacy_render),
+            ("template", lambda template, values: template.render(values)),
+            ("memoized", lambda template, values: BookElement.render(next(memoized), template, **values))]
+    results = {}
+    for name, func in runs:
+        elapsed, results[name] = measure(func, items, args.repeat)
+        print("{name:10} {total:10.3f} ms {per:8.2f} us per fragment".format(
+            name=name, total=elapsed * 1e3, per=elapsed / len(items) * 1e6))
+    if not results["legacy"] == results["template"] == results["memoized"]:
+        sys.exit("The fragments differ!")
+
+
+if __name__ == "__main__":
+    main()
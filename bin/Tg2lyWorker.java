@@ -0,0 +1,52 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+
+import tg2ly.LyExport;
+
+/*
+ * Converts .tg files with tg2ly, one after the other in the same JVM, so the
+ * JVM startup is paid once. Run it from source on the class path of the jar:
+ *
+ *     java -cp bin/tg2ly_0_3_1.jar bin/Tg2lyWorker.java
+ *
+ * Prints "ready" once it is started. Then it reads one request per line from
+ * stdin, "<out_path>\t<tg_file>\t<force>" with force "force" or empty, and
+ * answers every request with one line, "ok\t<hash>" or "error\t<message>".
+ * It exits at the end of stdin.
+ */
+public class Tg2lyWorker {
+
+	public static void main(String[] args) throws IOException {
+		PrintStream out = System.out;
+		BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+		out.println("ready");
+		out.flush();
+
+		String line;
+		while ((line = in.readLine()) != null) {
+			String[] request = line.split("\t", -1);
+			String reply;
+			if (request.length != 3) {
+				reply = "error\tinvalid request";
+			} else {
+				// LyExport prints the hash, catch it to answer in our format
+				ByteArrayOutputStream captured = new ByteArrayOutputStream();
+				System.setOut(new PrintStream(captured, true, "UTF-8"));
+				try {
+					new LyExport().export(request[1], request[0], request[2].equals("force"));
+					String[] lines = captured.toString("UTF-8").trim().split("\n");
+					reply = "ok\t" + lines[lines.length - 1].trim();
+				} catch (Exception e) {
+					reply = "error\t" + e;
+				} finally {
+					System.setOut(out);
+				}
+			}
+			out.println(reply.replace('\n', ' '));
+			out.flush();
+		}
+	}
+}
@@ -1,22 +1,80 @@
+import copy
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from limetusk.cache import ElementCache
+from limetusk.trace import tracer
 from limetusk.elements import BookElement, InvalidBookElementError
-from limetusk.elements import Title, CSong
+from limetusk.elements import Title, Chapter, CSong
+from limetusk.subset import Subset
 
 
 class BookOptions(object):
-    def __init__(self, in_path, out_path, midi=False, draft=False, verbose=0):
-        self.in_path  = in_path
-        self.out_path = out_path
-        self.midi     = midi
-        self.draft    = draft
-        self.verbose  = verbose
+    """Options of a build. All but the paths are keyword arguments, named
+    like the dests of the command line arguments.
+    """
+
+    def __init__(self, in_path, out_path, *, midi=False, draft=False, verbose=0, jobs=None, cache=True, clear_cache=False,
+                 watch=False, max_passes=4, split=False, recheck_env=False, trace=None, dpi=None, only=None,
+                 engine="lilypond-book", cache_dir=None, cache_limit=2048, max_jvms=None, max_memory=None, paper="a4",
+                 variants=None):
+        self.in_path     = in_path
+        self.out_path    = out_path
+        self.midi        = midi
+        self.draft       = draft
+        self.verbose     = verbose
+        self.jobs        = jobs or os.cpu_count() or 1
+        self.cache       = cache
+        self.clear_cache = clear_cache
+        self.watch       = watch
+        self.max_passes  = max_passes
+        self.split       = split
+        self.recheck_env = recheck_env
+        self.trace       = trace
+        self.dpi         = dpi
+        self.only        = only
+        self.engine      = engine
+        self.cache_dir   = cache_dir
+        self.cache_limit = cache_limit
+        self.max_jvms    = max_jvms
+        self.max_memory  = max_memory
+        self.paper       = paper
+        # name of the variant these options describe, see variant()
+        self.name        = None
+        self.variants    = [self.variant(spec) for spec in variants or []]
+
+    # settings of a variant and the options they set
+    variant_settings = {"midi":    ("midi", True),
+                        "no-midi": ("midi", False),
+                        "draft":   ("draft", True),
+                        "a4":      ("paper", "a4"),
+                        "a5":      ("paper", "a5")}
+
+    def variant(self, spec):
+        """Options of the output variant described by spec, "NAME" or
+        "NAME:SETTING,...", e.g. "print:a4,midi" or "proof:draft". Settings
+        not given are taken from these options. Raises ValueError for an
+        invalid spec.
+        """
+        name, _, settings = spec.partition(":")
+        if not name or not name.replace("-", "").replace("_", "").isalnum():
+            raise ValueError("Invalid variant name: " + spec)
+        ret = copy.copy(self)
+        ret.name     = name
+        ret.variants = []
+        for setting in filter(None, settings.split(",")):
+            if setting not in self.variant_settings:
+                raise ValueError("Unknown setting {setting} of variant {name}, expected one of {settings}.".format(
+                    setting=setting, name=name, settings=", ".join(self.variant_settings)))
+            attr, value = self.variant_settings[setting]
+            setattr(ret, attr, value)
+        return ret
 
 
 class Book(object):
     # TODO: attachfile only needed, if --midi is set
-    lytex_header_template = r"""
-        \documentclass[a4paper, twoside, DIV=15, cleardoublepage=empty, final]{{scrbook}}
+    lytex_preamble_template = r"""
+        \documentclass[{paper}paper, twoside, DIV=15, cleardoublepage=empty, final]{{scrbook}}
         \usepackage[utf8]{{inputenc}}
         \usepackage[T1]{{fontenc}}
         \usepackage[ngerman, english]{{babel}}
@@ -39,33 +97,87 @@ class Book(object):
             while the document itself is licensed under the Creative Commons BY-SA 3.0 license.
         }}
         \begin{{document}}
-            \maketitle
+"""
+
+    lytex_front = r"""            \maketitle
             \tableofcontents    
     """
 
+    lytex_header_template = lytex_preamble_template + lytex_front
+
     lytex_footer = r"""
         \end{document}
     """
 
-    def __init__(self, book_path, options):
+    def __init__(self, book_path, options, parse=True):
         self.book_path = book_path
         self.options   = options
         self.base_path = os.path.dirname(book_path)
+        self.content   = None
+        self.title     = None
+
+        # shared by all books using the cache directory
+        self.element_cache = ElementCache(options.cache_dir or options.out_path, options.cache)
+        if options.clear_cache:
+            self.element_cache.clear()
+        self.subset = Subset(options.only) if options.only else None
+        if parse:
+            self.parse()
 
-        self.content = self.parse_book()
+    def parse(self, on_element=None):
+        """Parse the book. on_element is called with every element of the
+        content as soon as it is known.
+        """
+        content      = self.parse_book(on_element=None if self.subset else on_element)
+        self.content = self.select(content)
+        self.title   = self.find_title()
+        if self.subset and on_element:
+            for e in self.content:
+                on_element(e)
 
-        self.title = "Songbook"
+    def find_title(self):
         title_list = [e for e in self.content if isinstance(e, Title)]
         if len(title_list) == 0:
             logging.warning("Title not defined. Default is being used.")
-        else:
-            if len(title_list) != 1:
-                logging.warning("Multiple titles defines. First found used.")
-            self.title = title_list[0].title
+            return "Songbook"
+        if len(title_list) != 1:
+            logging.warning("Multiple titles defines. First found used.")
+        return title_list[0].title
+
+    def files(self):
+        """The book file and all files its elements were created from."""
+        ret = [self.book_path]
+        for e in self.content:
+            ret += e.files()
+        return list(dict.fromkeys(ret))
+
+    def reload(self, changed_paths):
+        """Parse the book again. Elements whose line is unchanged and whose
+        files are not in changed_paths are reused instead of parsed again.
+        """
+        reuse = {}
+        for e in self.content:
+            if e.source and not set(e.files()) & set(changed_paths):
+                reuse[e.source] = e
+        self.content = self.select(self.parse_book(reuse))
+        self.title   = self.find_title()
+
+    def select(self, content):
+        """Apply the --only filters to the content."""
+        return self.subset.select(content) if self.subset else content
 
-    def parse_book(self):
+    def parse_book(self, reuse=None, on_element=None):
+        """Parse the book file. Elements are taken from reuse or the element
+        cache if possible, the remaining element files are read by a pool of
+        threads. The content keeps the order of the book file. on_element is
+        called with every element as soon as it and all before it are parsed.
+        """
+        reuse = reuse or {}
         ret = []
-        with open(self.book_path, "r") as fd:
+        self.element_cache.reset_stats()
+        with tracer.span(os.path.basename(self.book_path), "parse"), open(self.book_path, "r") as fd, \
+                ThreadPoolExecutor(max_workers=self.options.jobs) as pool:
+            lines = []
             line_no = 0
             for raw_line in fd:
                 line_no += 1
@@ -75,28 +187,68 @@ class Book(object):
                 if len(line) == 0:
                     continue
                 line = line.split(":", maxsplit=1)
+                if len(line) != 2:
+                    logging.error('Invalid line {line_no}: "{line}"'.format(line_no=line_no, line=raw_line))
+                    continue
+                future = None
+                if (line[0], line[1]) not in reuse:
+                    future = pool.submit(BookElement.factory, self.base_path, self.options, line[0], line[1],
+                                         self.element_cache)
+                lines.append((line_no, raw_line, line, future))
+            for line_no, raw_line, line, future in lines:
                 try:
-                    e = BookElement.factory(self.base_path, self.options, line[0], line[1])
+                    e = future.result() if future else reuse[(line[0], line[1])]
                     ret.append(e)
                     logging.debug(e)
-                except (InvalidBookElementError, IndexError):
+                    if on_element:
+                        on_element(e)
+                except InvalidBookElementError:
                     logging.error('Invalid line {line_no}: "{line}"'.format(line_no=line_no, line=raw_line))
+        self.element_cache.save()
+        if self.element_cache.enabled:
+            logging.info("Element cache: {hits} hits, {misses} misses".format(hits=self.element_cache.hits,
+                                                                              misses=self.element_cache.misses))
+        return ret
+
+    def split_chapters(self):
+        """Partition the content at chapter boundaries. The first part holds
+        everything before the first chapter and may be empty.
+        """
+        ret = [[]]
+        for e in self.content:
+            if isinstance(e, Chapter):
+                ret.append([])
+            ret[-1].append(e)
         return ret
 
     def generate(self):
+        return "".join(self.generate_iter())
+
+    def generate_iter(self, content=None, header=None, options=None):
+        """Yield the lytex document fragment by fragment, so it can be written
+        out without holding the whole document in memory. content and header
+        default to the whole book and the regular header, options to the
+        options of the book.
+        """
+        if content is None:
+            content = self.content
+        if options is None:
+            options = self.options
+        if header is None:
+            header = Book.lytex_header_template.format(title=self.title, paper=options.paper)
         # TODO: change begin_env/end_env stuff more generally
         last_item = None
-        ret = ""
-        ret += Book.lytex_header_template.format(title=self.title)
-        for e in self.content:
+        yield header
+        for e in content:
             if (not isinstance(last_item, CSong)) and isinstance(e, CSong):
-                ret += CSong.begin_env()
-            ret += e.generate()
+                yield CSong.begin_env()
+            with tracer.span(str(e), "generate") as trace_args:
+                fragment = e.generate(options)
+                trace_args["output_size"] = len(fragment)
+            yield fragment
             if isinstance(last_item, CSong) and (not isinstance(e, CSong)):
-                ret += CSong.end_env()
+                yield CSong.end_env()
             last_item = e
         if isinstance(last_item, CSong):
-            ret += CSong.end_env()
-        ret += str(Book.lytex_footer)
-        return ret
-
+            yield CSong.end_env()
+        yield str(Book.lytex_footer)
@@ -1,50 +1,412 @@
+import glob
 import subprocess
 import logging
 import os
 import shutil
+import limetusk.trace
 import limetusk.util
+from limetusk.cache import ArtifactCache, ConversionCache
+from limetusk.trace import tracer
+from limetusk.elements import Song, Picture
+from limetusk.images import Image
+from limetusk.manifest import BuildManifest
+from limetusk.scheduler import Scheduler, physical_memory
+from limetusk.tg2ly import Tg2lyError, Tg2lyWorkerPool
 
 
 class BookBuilder(object):
     def __init__(self, book, options):
-        self.book    = book
-        self.options = options
+        self.book      = book
+        self.options   = options
+        self.manifest  = None
+        self.scheduler = None
+        self.artifacts = None
+        if options.cache_dir and options.cache:
+            self.artifacts = ArtifactCache(options.cache_dir, options.cache_limit << 20)
+        # a Tg2lyWorkerPool kept between builds, e.g. by the build server
+        self.workers   = None
 
     def build(self):
+        """Build the book. Returns whether all stages succeeded, failures
+        are logged.
+        """
+        self.prepare()
+
         logging.info("Generating book...")
-        self.generate_lytex()
+        self.generate_lytex(path=self.tex_path() if self.direct_tex() else None)
 
         logging.info("Compiling book...")
-        self.generate_tex()
-        self.compile_tex(draft=True)
-        if not self.options.draft:
-            self.compile_tex(draft=False)
+        # copy sty first, since lilypond-book tries to guess the textwidth
+        shutil.copy(limetusk.util.LIMETUSK_STY, self.options.out_path)
+        ok = True
+        if not self.direct_tex():
+            ok = self.run_stage("lilypond-book", self.lilypond_book_inputs(), [self.tex_path()], self.generate_tex)
+        return self.run_stage("pdflatex", self.pdflatex_inputs(), self.pdflatex_outputs(), self.compile_passes) and ok
+
+    # rough peak memory of the tasks in MiB, for --max-memory
+    task_memory = {"convert": 256,
+                   "lilypond": 256,
+                   "image": 128}
+
+    def resource_limits(self):
+        limits = {"jvm":      self.options.max_jvms or self.options.jobs,
+                  "lilypond": self.options.jobs,
+                  "cpu":      self.options.jobs}
+        memory = self.options.max_memory or (physical_memory() or 0) // 2
+        if memory:
+            limits["memory"] = memory
+        return limits
 
-    def generate_lytex(self):
+    def targets(self):
+        """Options of every document built, one per variant."""
+        return self.options.variants or [self.options]
+
+    def prepare(self):
+        """Parse the book, unless it is parsed already, and prepare all its
+        elements with a graph of tasks: a song is converted, then its midi
+        file and its systems are rendered; pictures are downsampled. The
+        tasks of an element are added as soon as it is parsed. Songs are
+        prepared once for all variants. Draft builds only show placeholders
+        and skip all of it.
+        """
         os.makedirs(self.options.out_path, exist_ok=True)
-        lytex_path = os.path.join(self.options.out_path, self.book.title + ".lytex")
-        with open(lytex_path, "w") as fd:
-            fd.write(self.book.generate())
+        self.manifest = BuildManifest(self.options.out_path)
+        targets = [options for options in self.targets() if not options.draft]
+        if not targets:
+            if self.book.content is None:
+                self.book.parse()
+            return
 
-    def generate_tex(self):
-        # copy sty first, since lilypond-book tries to guess the textwidth
-        shutil.copy(limetusk.util.LIMETUSK_STY, self.options.out_path)
+        self.scheduler = Scheduler(self.resource_limits())
+        self.conversion_cache = ConversionCache(self.options.out_path, self.options.cache)
+        if self.options.clear_cache:
+            self.conversion_cache.clear()
+        # songs are converted by warm tg2ly workers, at most one per jvm slot
+        self.tg2ly = None
+        if limetusk.util.tg2ly_worker_available():
+            self.tg2ly = self.workers or Tg2lyWorkerPool()
+        self.song_tasks = {}
+        self.midi = any(options.midi for options in targets)
+        # paper size -> hash of the paper settings of the systems rendered for it
+        self.papers = {}
+        if self.options.engine == "lilypond":
+            for paper in sorted(set(options.paper for options in targets)):
+                self.papers[paper] = limetusk.util.file_hash(Song.write_paper_settings(self.options.out_path, paper))
+        if self.options.dpi and Image is None:
+            logging.warning("Pillow not found, pictures are included as they are.")
+
+        try:
+            if self.book.content is None:
+                logging.info("Parsing book and preparing songs...")
+                self.scheduler.run(lambda: self.book.parse(self.schedule))
+            else:
+                logging.info("Preparing songs...")
+                for e in self.book.content:
+                    self.schedule(e)
+                self.scheduler.run()
+        finally:
+            if self.tg2ly and self.tg2ly is not self.workers:
+                self.tg2ly.close()
+
+        self.conversion_cache.save()
+        if self.conversion_cache.enabled:
+            logging.info("Conversion cache: {hits} hits, {misses} misses".format(hits=self.conversion_cache.hits,
+                                                                                 misses=self.conversion_cache.misses))
+        self.log_artifacts()
+
+    def schedule(self, e):
+        """Add the tasks preparing the element e."""
+        if isinstance(e, Song):
+            self.schedule_song(e)
+        elif isinstance(e, Picture) and self.options.dpi and Image is not None:
+            self.scheduler.add("image " + e.init_path, lambda: self.downsample_picture(e),
+                               resources={"cpu": 1, "memory": self.task_memory["image"]})
+
+    def schedule_song(self, song):
+        tg_file = song.data["tg_file"]
+        if tg_file in self.song_tasks:
+            # songs used more than once share the same tg file and output
+            first, tasks = self.song_tasks[tg_file]
+            self.scheduler.add("copy " + song.init_path, lambda: song.copy_state(first), deps=tasks)
+            return
+
+        tasks = []
+        if not self.lookup_song(song, self.conversion_cache):
+            tasks.append(self.scheduler.add("convert " + song.init_path,
+                                            lambda: self.convert_song(song, self.conversion_cache),
+                                            resources={"jvm": 1, "memory": self.task_memory["convert"]}))
+        converted = list(tasks)
+        lilypond  = {"lilypond": 1, "memory": self.task_memory["lilypond"]}
+        if self.midi:
+            tasks.append(self.scheduler.add("midi " + song.init_path, lambda: self.render_song_midi(song),
+                                            deps=converted, resources=lilypond))
+        for paper, settings_hash in self.papers.items():
+            tasks.append(self.scheduler.add("render {paper} {path}".format(paper=paper, path=song.init_path),
+                                            lambda paper=paper, settings_hash=settings_hash:
+                                                self.render_song_systems(song, paper, settings_hash),
+                                            deps=converted, resources=lilypond))
+        self.song_tasks[tg_file] = (song, tasks)
+
+    def lookup_song(self, song, cache):
+        """Take the hash of the song from the conversion cache or the shared
+        artifact cache. Returns True, if the song needs no conversion.
+        """
+        tg_file   = song.data["tg_file"]
+        song_hash = cache.get(tg_file)
+        if not song_hash and self.artifacts:
+            names = self.artifacts.get(self._artifact_key(tg_file), self.options.out_path)
+            if names:
+                song_hash = os.path.splitext(names[0])[0]
+                cache.put(tg_file, song_hash)
+        if song_hash:
+            song.data["hash"] = song_hash
+        return bool(song_hash)
+
+    def convert_song(self, song, cache):
+        """Convert the song with tg2ly, with a warm worker if possible. The
+        hash is stored in the song and the caches. A failing song is logged
+        and left out of the book.
+        """
+        tg_file = song.data["tg_file"]
+        # the .ly file may be newer but hold another version of the song,
+        # only tg2ly's own check is left without the cache
+        force = cache.enabled
+        try:
+            song_hash = None
+            if self.tg2ly:
+                try:
+                    song_hash = self.tg2ly.convert(tg_file, self.options.out_path, force)
+                except Tg2lyError as e:
+                    # converted alone below, which reports the error of tg2ly
+                    logging.debug("tg2ly worker failed on {path}: {error}".format(path=tg_file, error=e))
+            song_hash = song_hash or song.convert(force)
+        except (subprocess.CalledProcessError, OSError) as e:
+            song.data["hash"] = None
+            logging.error("Converting {path} failed: {error}".format(path=song.init_path, error=e))
+            return
+        song.data["hash"] = song_hash
+        cache.put(tg_file, song_hash)
+        if self.artifacts:
+            self.artifacts.put(self._artifact_key(tg_file), [os.path.join(self.options.out_path, song_hash + ".ly")])
+
+    def render_song_midi(self, song):
+        """Render the midi file of the converted song, unless its .midi file
+        is newer than its .ly file. A failing song is logged and attached
+        without midi.
+        """
+        if not song.data.get("hash") or song.midi_up_to_date():
+            return
+        try:
+            self._shared("midi", song, song.generate_midi, [".midi"])
+        except (subprocess.CalledProcessError, OSError) as e:
+            song.midi_failed = True
+            logging.error("Rendering midi of {path} failed: {error}".format(path=song.init_path, error=e))
+
+    def render_song_systems(self, song, paper, settings_hash):
+        """Render the systems of the converted song for the lilypond engine
+        and the paper size, unless they are newer than its .ly file.
+        settings_hash is the hash of the paper settings. A failing song is
+        logged and left out of the book.
+        """
+        if not song.data.get("hash") or song.systems_up_to_date(paper):
+            return
+        try:
+            self._shared("systems", song, lambda: song.render_systems(paper),
+                         ["-{paper}-systems.tex".format(paper=paper), "-{paper}-*.pdf".format(paper=paper)],
+                         paper, settings_hash)
+        except (subprocess.CalledProcessError, OSError) as e:
+            song.render_failed = True
+            logging.error("Rendering {path} failed: {error}".format(path=song.init_path, error=e))
+
+    @staticmethod
+    def _artifact_key(tg_file):
+        return ArtifactCache.key("tg2ly", ConversionCache.key(tg_file))
+
+    def _shared(self, kind, song, func, patterns, *settings):
+        """Run func for the song, unless the shared artifact cache has its
+        results. The key covers the .ly file, lilypond and settings. The
+        files matching patterns (appended to the song's hash) are stored in
+        the cache afterwards.
+        """
+        if not self.artifacts:
+            return func()
+        rel_path = os.path.join(self.options.out_path, song.data["hash"])
+        key = ArtifactCache.key(kind, song.data["hash"], limetusk.util.file_hash(rel_path + ".ly"),
+                                limetusk.util.tool_versions()["lilypond"], *settings)
+        if self.artifacts.get(key, self.options.out_path):
+            return
+        func()
+        paths = []
+        for pattern in patterns:
+            paths += sorted(glob.glob(glob.escape(rel_path) + pattern))
+        self.artifacts.put(key, paths)
+
+    def log_artifacts(self):
+        """Log the hits of the shared artifact cache and save its index."""
+        if not self.artifacts:
+            return
+        if self.artifacts.hits or self.artifacts.misses:
+            logging.info("Artifact cache: {hits} hits, {misses} misses".format(hits=self.artifacts.hits,
+                                                                               misses=self.artifacts.misses))
+        self.artifacts.save()
+
+    def downsample_picture(self, picture):
+        """Downsample the picture. A picture that fails is logged and included
+        as it is.
+        """
+        try:
+            picture.image_path = picture.downsample()
+        except (OSError, ValueError) as e:
+            picture.image_path = None
+            logging.error("Downsampling {path} failed: {error}".format(path=picture.init_path, error=e))
+
+    def direct_tex(self):
+        """True, if the document contains no snippets for lilypond-book, so
+        it is written as tex directly. That's the case for draft builds and
+        the lilypond engine.
+        """
+        return self.options.draft or self.options.engine == "lilypond"
+
+    def run_stage(self, stage, inputs, outputs, func):
+        """Run func, unless the manifest says the stage is up to date. func
+        returns True on success, only then the stage is recorded. Returns
+        whether the stage is up to date afterwards.
+        """
+        if self.manifest.up_to_date(stage, inputs, outputs):
+            logging.info("Skipping {stage}, nothing changed.".format(stage=stage))
+            return True
+        if func():
+            self.manifest.update(stage, inputs, outputs)
+            return True
+        self.manifest.invalidate(stage)
+        return False
+
+    def lytex_path(self, name=None):
+        return os.path.join(self.options.out_path, (name or self.book.title) + ".lytex")
+
+    def tex_path(self, name=None):
+        return os.path.join(self.options.out_path, (name or self.book.title) + ".tex")
+
+    def lilypond_book_inputs(self, name=None, content=None):
+        versions = limetusk.util.tool_versions()
+        return {"lytex":         self._hash_files([self.lytex_path(name)]),
+                "ly":            self._hash_files(self._song_files(".ly", content)),
+                "lilypond-book": versions["lilypond-book"],
+                "lilypond":      versions["lilypond"]}
+
+    def pdflatex_inputs(self, name=None, content=None):
+        if content is None:
+            content = self.book.content
+        files  = [limetusk.util.LIMETUSK_STY]
+        files += [e.graphic_path() for e in content if isinstance(e, Picture)]
+        if self.options.midi:
+            files += self._song_files(".midi", content)
+        if self.options.engine == "lilypond" and not self.options.draft:
+            for rel_path in self._song_files("-" + self.options.paper, content):
+                files += [rel_path + "-systems.tex"] + sorted(glob.glob(glob.escape(rel_path) + "-*.pdf"))
+        return {"tex":      self._hash_files([self.tex_path(name)]),
+                "files":    self._hash_files(files),
+                "pdflatex": limetusk.util.tool_versions()["pdflatex"],
+                "draft":    self.options.draft}
+
+    def pdflatex_outputs(self, name=None):
+        rel_path = os.path.join(self.options.out_path, name or self.book.title)
+        return [rel_path + ".pdf"]
+
+    def _song_files(self, ext, content=None):
+        if content is None:
+            content = self.book.content
+        songs = [e for e in content if isinstance(e, Song) and e.data.get("hash") and not e.render_failed]
+        if ext == ".midi":
+            songs = [e for e in songs if not e.midi_failed]
+        return sorted(set(os.path.join(self.options.out_path, e.data["hash"] + ext) for e in songs))
+
+    @staticmethod
+    def _hash_files(paths):
+        return {path: limetusk.util.file_hash(path) if os.path.exists(path) else None for path in paths}
+
+    def generate_lytex(self, name=None, content=None, header=None, path=None):
+        """Stream the lytex file into a temporary file, which only replaces
+        the existing one if the content changed. path defaults to the lytex
+        file of the book or part.
+        """
+        os.makedirs(self.options.out_path, exist_ok=True)
+        lytex_path = path or self.lytex_path(name)
+        tmp_path   = lytex_path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            for fragment in self.book.generate_iter(content, header, self.options):
+                fd.write(fragment)
+        if os.path.exists(lytex_path) and \
+           limetusk.util.file_hash(tmp_path) == limetusk.util.file_hash(lytex_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, lytex_path)
+
+    def generate_tex(self, name=None):
         cmd  = ["lilypond-book", "--pdf"]
         cmd += [] if self.options.verbose else ["--loglevel=WARN", "--lily-loglevel=WARN"]
         cmd += ["--format=latex"]
         cmd += ["--out="+self.options.out_path]
-        cmd += [os.path.join(self.options.out_path, self.book.title + ".lytex")]
-        subprocess.call(cmd)
+        cmd += [self.lytex_path(name)]
+        with tracer.span(os.path.basename(self.lytex_path(name)), "lilypond-book") as trace_args:
+            ret = limetusk.trace.run(cmd).returncode
+            if os.path.exists(self.tex_path(name)):
+                trace_args["output_size"] = os.path.getsize(self.tex_path(name))
+        return ret == 0
+
+    # auxiliary files whose content can change the next pdflatex pass
+    aux_extensions = [".aux", ".toc", ".out", ".lop", ".sxd", ".sxc", ".sbx"]
 
-    def compile_tex(self, draft=False):
+    def aux_snapshot(self, name=None):
+        rel_path = os.path.join(self.options.out_path, name or self.book.title)
+        return self._hash_files([rel_path + ext for ext in self.aux_extensions])
+
+    def aux_stale(self, name=None):
+        """True, if the aux file of the previous build is missing or older
+        than the tex file.
+        """
+        aux_path = os.path.join(self.options.out_path, (name or self.book.title) + ".aux")
+        try:
+            return os.path.getmtime(aux_path) < os.path.getmtime(self.tex_path(name))
+        except OSError:
+            return True
+
+    def compile_passes(self, name=None):
+        """Run pdflatex until the auxiliary files stop changing, at most
+        --max-passes times. A cheaper draft pass is run first, if the
+        auxiliary files of the previous build can't be trusted and the limit
+        leaves room for it.
+        """
+        passes = 0
+        if self.options.max_passes > 1 and self.aux_stale(name):
+            if not self.compile_tex(draft=True, name=name):
+                return False
+            passes += 1
+        while True:
+            before = self.aux_snapshot(name)
+            if not self.compile_tex(draft=False, name=name):
+                return False
+            passes += 1
+            if self.aux_snapshot(name) == before:
+                break
+            if passes >= self.options.max_passes:
+                logging.warning("Auxiliary files still changing after {passes} pdflatex passes.".format(passes=passes))
+                break
+        logging.debug("pdflatex finished after {passes} passes.".format(passes=passes))
+        return True
+
+    def compile_tex(self, draft=False, name=None):
         cmd  = ["pdflatex"]
         cmd += ["-draftmode"] if draft else []
         cmd += ["-interaction=nonstopmode"]
         cmd += ["-output-directory=" + self.options.out_path]
-        cmd += [self.book.title + ".tex"]
+        cmd += [(name or self.book.title) + ".tex"]
         temp_env = os.environ.copy()
         temp_env['TEXINPUTS'] = self.options.out_path + ":" + temp_env.get('TEXINPUTS', '')
-        if self.options.verbose == 2:
-            subprocess.call(cmd, env=temp_env)
-        else:
-            subprocess.call(cmd, stdout=subprocess.DEVNULL, env=temp_env)
+        stdout   = None if self.options.verbose == 2 else subprocess.DEVNULL
+        pdf_path = os.path.join(self.options.out_path, (name or self.book.title) + ".pdf")
+        with tracer.span((name or self.book.title) + ".tex", "pdflatex", draft=draft) as trace_args:
+            ret = limetusk.trace.run(cmd, stdout=stdout, env=temp_env).returncode
+            if not draft and os.path.exists(pdf_path):
+                trace_args["output_size"] = os.path.getsize(pdf_path)
+        return ret == 0
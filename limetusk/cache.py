@@ -0,0 +1,396 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import limetusk.util
+
+
+class JsonCache(object):
+    """A dict of cache entries kept in the JSON file file_name of the
+    directory path. Counts hits and misses of the lookups of its subclasses.
+    """
+    file_name = None
+    name      = None
+
+    def __init__(self, path, enabled=True):
+        self.path       = path
+        self.enabled    = enabled
+        self.cache_path = os.path.join(path, self.file_name)
+        self.hits       = 0
+        self.misses     = 0
+        self.entries    = self.empty()
+        if self.enabled:
+            self.load()
+
+    def empty(self):
+        return {}
+
+    def read(self):
+        """The entries in the file."""
+        try:
+            with open(self.cache_path, "r") as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return self.empty()
+        except ValueError:
+            logging.warning("{name} corrupt, ignoring it: {path}".format(name=self.name, path=self.cache_path))
+            return self.empty()
+
+    def load(self):
+        self.entries = self.read()
+
+    def save(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        limetusk.util.write_json(self.cache_path, self.entries)
+
+    def clear(self):
+        self.entries = self.empty()
+        try:
+            os.remove(self.cache_path)
+        except FileNotFoundError:
+            pass
+
+    def reset_stats(self):
+        self.hits   = 0
+        self.misses = 0
+
+
+class ConversionCache(JsonCache):
+    """Persistent cache of tg2ly conversions. The key combines the content
+    hash and the file name of the .tg file (tg2ly derives the output name from
+    it) with the tg2ly version, which includes the jar's hash. The entry holds
+    the hash tg2ly printed for it and the hash of the .ly file it wrote. Other
+    versions of the .tg file are converted to the same .ly file, so an entry
+    is only used while the .ly file still has that content.
+    """
+    file_name = ".limetusk_cache.json"
+    name      = "Conversion cache"
+
+    def __init__(self, out_path, enabled=True):
+        self.out_path = out_path
+        super().__init__(out_path, enabled)
+
+    @staticmethod
+    def key(tg_file):
+        return ":".join([limetusk.util.file_hash(tg_file),
+                         os.path.basename(tg_file),
+                         limetusk.util.tool_versions()["tg2ly"]])
+
+    def get(self, tg_file):
+        """Return the cached hash for tg_file, or None."""
+        if not self.enabled:
+            return None
+        entry = self.entries.get(self.key(tg_file))
+        try:
+            valid = (isinstance(entry, dict) and
+                     entry["ly_hash"] == limetusk.util.file_hash(os.path.join(self.out_path, entry["hash"] + ".ly")))
+        except OSError:
+            valid = False
+        if valid:
+            self.hits += 1
+            return entry["hash"]
+        self.misses += 1
+        return None
+
+    def put(self, tg_file, song_hash):
+        """Store song_hash for tg_file, after its .ly file was written."""
+        if self.enabled:
+            ly_hash = limetusk.util.file_hash(os.path.join(self.out_path, song_hash + ".ly"))
+            self.entries[self.key(tg_file)] = {"hash": song_hash, "ly_hash": ly_hash}
+
+
+class ElementCache(JsonCache):
+    """Persistent cache of parsed element files. The key is the keyword and
+    the absolute path of the element file, the entry holds the validated data
+    dict together with the missing and unused keys, so the warnings can be
+    repeated. An entry is only used while mtime and size of the file match.
+    Since the keys are absolute, the cache can be shared by several books, so
+    save() merges the entries added by this book into the file.
+    """
+    file_name = ".limetusk_elements.json"
+    name      = "Element cache"
+    version   = 1
+
+    def __init__(self, path, enabled=True):
+        self.lock  = threading.Lock()
+        self.added = {}
+        super().__init__(path, enabled)
+
+    def empty(self):
+        return {"version": self.version}
+
+    def load(self):
+        super().load()
+        if self.entries.get("version") != self.version:
+            self.entries = self.empty()
+
+    def save(self):
+        with self.lock:
+            added, self.added = self.added, {}
+        if not self.enabled or not added:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.cache_path + ".lock", "a") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                entries = self.read()
+                if entries.get("version") != self.version:
+                    entries = self.empty()
+                entries.update(added)
+                limetusk.util.write_json(self.cache_path, entries)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        with self.lock:
+            self.entries = dict(entries, **self.entries)
+
+    @staticmethod
+    def key(keyword, path):
+        return keyword + ":" + os.path.abspath(path)
+
+    @staticmethod
+    def stat(path):
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+
+    def get(self, keyword, path):
+        """Return the cached entry for the element file, or None."""
+        if not self.enabled:
+            return None
+        entry = self.entries.get(self.key(keyword, path))
+        try:
+            valid = entry is not None and entry["stat"] == self.stat(path)
+        except OSError:
+            valid = False
+        with self.lock:
+            if valid:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry if valid else None
+
+    def put(self, keyword, path, entry):
+        """Store the entry. entry["stat"] has to be taken with stat() before
+        the file was read.
+        """
+        if not self.enabled:
+            return
+        try:
+            # literal_eval also knows sets and bytes, such files are not cached
+            json.dumps(entry)
+        except TypeError:
+            return
+        key = self.key(keyword, path)
+        with self.lock:
+            self.entries[key] = entry
+            self.added[key]   = entry
+
+
+class ArtifactCache(object):
+    """Cache of build artifacts shared by all books, e.g. the .ly files of
+    tg2ly, .midi files and rendered systems. Every entry is a directory of
+    files under objects/, named after a key derived from the content of the
+    inputs. Entries are written to tmp/ and renamed into place, and renamed
+    away before they are deleted, so readers don't need the lock.
+    index.json records size and last use of every entry. It is only changed
+    while holding the flock on the lock file, which makes concurrent builds
+    safe. When the entries exceed max_size bytes, the least recently used ones
+    are evicted.
+    """
+    index_name = "index.json"
+    lock_name  = "lock"
+    version    = 1
+    # age in seconds after which a directory in tmp/ is a leftover
+    stale_age  = 3600
+
+    def __init__(self, path, max_size=None):
+        self.path     = path
+        self.max_size = max_size
+        self.lock     = threading.Lock()
+        self.used     = {}
+        self.added    = {}
+        self.hits     = 0
+        self.misses   = 0
+
+    @staticmethod
+    def key(kind, *parts):
+        return hashlib.sha1("\0".join((kind,) + parts).encode("utf-8")).hexdigest()
+
+    def _object_path(self, key):
+        return os.path.join(self.path, "objects", key[:2], key)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the lock of the cache directory, also against other processes."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, self.lock_name), "a") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.path, self.index_name), "r") as fd:
+                index = json.load(fd)
+            if index.get("version") == self.version:
+                return index
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logging.warning("Artifact cache index corrupt, rebuilding it: " + self.path)
+        return {"version": self.version, "entries": {}, "hits": 0, "misses": 0}
+
+    def _write_index(self, index):
+        limetusk.util.write_json(os.path.join(self.path, self.index_name), index)
+
+    def get(self, key, dst_path):
+        """Copy the files of the entry to dst_path. Returns their names, or
+        None if there is no such entry.
+        """
+        obj_path = self._object_path(key)
+        try:
+            names = sorted(os.listdir(obj_path))
+            for name in names:
+                tmp_path = os.path.join(dst_path, name + ".tmp")
+                shutil.copyfile(os.path.join(obj_path, name), tmp_path)
+                os.replace(tmp_path, os.path.join(dst_path, name))
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.used[key] = time.time()
+        return names
+
+    def put(self, key, paths):
+        """Store copies of the files as entry for key."""
+        obj_path = self._object_path(key)
+        if os.path.isdir(obj_path):
+            return
+        tmp_path = None
+        try:
+            tmp_path = self._mkdtemp()
+            os.makedirs(os.path.dirname(obj_path), exist_ok=True)
+            size = 0
+            for path in paths:
+                shutil.copyfile(path, os.path.join(tmp_path, os.path.basename(path)))
+                size += os.path.getsize(path)
+            os.rename(tmp_path, obj_path)
+        except OSError:
+            # e.g. another build stored the same entry in the meantime
+            if tmp_path:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        with self.lock:
+            self.added[key] = size
+            self.used[key]  = time.time()
+
+    def _mkdtemp(self):
+        """A new directory under tmp/, for staging or deleting entries."""
+        tmp_root = os.path.join(self.path, "tmp")
+        os.makedirs(tmp_root, exist_ok=True)
+        return tempfile.mkdtemp(dir=tmp_root)
+
+    def save(self):
+        """Record the entries used and added by this build in the index and
+        evict entries, if the cache got too large.
+        """
+        with self.lock:
+            used, self.used   = self.used, {}
+            added, self.added = self.added, {}
+            hits, misses      = self.hits, self.misses
+            self.hits = self.misses = 0
+        if not (used or added or hits or misses):
+            return
+        with self.locked():
+            index   = self._read_index()
+            entries = index["entries"]
+            for key, size in added.items():
+                # a concurrent prune may have removed it already
+                if os.path.isdir(self._object_path(key)):
+                    entries[key] = {"size": size, "used": used[key]}
+            for key, used_time in used.items():
+                if key in entries:
+                    entries[key]["used"] = max(entries[key]["used"], used_time)
+            index["hits"]   += hits
+            index["misses"] += misses
+            if self.max_size is not None:
+                self._evict(index, self.max_size)
+            self._write_index(index)
+
+    def _evict(self, index, max_size):
+        entries = index["entries"]
+        total   = sum(e["size"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["used"]):
+            if total <= max_size:
+                break
+            obj_path = self._object_path(key)
+            dead_path = self._mkdtemp()
+            try:
+                os.rename(obj_path, os.path.join(dead_path, key))
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(dead_path, ignore_errors=True)
+            total -= entries.pop(key)["size"]
+
+    def _orphans(self, index):
+        """Entries of builds that ended before they could save the index."""
+        ret = {}
+        objects_path = os.path.join(self.path, "objects")
+        for prefix in os.listdir(objects_path) if os.path.isdir(objects_path) else []:
+            for key in os.listdir(os.path.join(objects_path, prefix)):
+                if key not in index["entries"]:
+                    obj_path = os.path.join(objects_path, prefix, key)
+                    size = sum(os.path.getsize(os.path.join(obj_path, name)) for name in os.listdir(obj_path))
+                    ret[key] = {"size": size, "used": os.path.getmtime(obj_path)}
+        return ret
+
+    def stats(self):
+        """Number of entries, their total size and hit/miss counts."""
+        with self.locked():
+            index = self._read_index()
+            index["entries"].update(self._orphans(index))
+        entries = index["entries"].values()
+        return {"path":     self.path,
+                "entries":  len(entries),
+                "size":     sum(e["size"] for e in entries),
+                "max_size": self.max_size,
+                "oldest":   min((e["used"] for e in entries), default=None),
+                "hits":     index["hits"],
+                "misses":   index["misses"]}
+
+    def _remove_stale_tmp(self):
+        """Remove directories under tmp/ left by interrupted builds. put()
+        stages entries there without the lock, so only directories older than
+        stale_age seconds are removed, not those of builds running now.
+        """
+        tmp_root = os.path.join(self.path, "tmp")
+        now = time.time()
+        for name in os.listdir(tmp_root) if os.path.isdir(tmp_root) else []:
+            tmp_path = os.path.join(tmp_root, name)
+            try:
+                if now - os.path.getmtime(tmp_path) > self.stale_age:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+    def prune(self, max_size):
+        """Evict least recently used entries until the cache holds at most
+        max_size bytes. Also cleans up leftovers of interrupted builds.
+        """
+        with self.locked():
+            index = self._read_index()
+            index["entries"].update(self._orphans(index))
+            self._remove_stale_tmp()
+            self._evict(index, max_size)
+            self._write_index(index)
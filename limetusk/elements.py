@@ -1,18 +1,49 @@
 import os.path
 import ast
-import subprocess
 import logging
+import limetusk.images
+import limetusk.trace
 import limetusk.util
-from limetusk.util import escape_latex
+from limetusk.trace import tracer
+from limetusk.render import Template
 
 
 class InvalidBookElementError(Exception):
     pass
 
 class BookElement(object):
-    def generate(self):
+    # keys read again on generate(), so large values are not kept in memory
+    lazy = []
+
+    def __init__(self):
+        # template -> values and fragment of the last render()
+        self.fragments = {}
+
+    def generate(self, options=None):
+        """The lytex of the element. options are the options of the variant
+        generated and default to the options the element was created with.
+        """
         raise NotImplementedError("please implement!")
 
+    def files(self):
+        """Files the element was created from, used to detect changes."""
+        return []
+
+    def render(self, template, **values):
+        """Render the template with values. The fragment is kept and returned
+        again while the values stay the same, unless the element has lazy
+        keys, whose values would be kept in memory with it.
+        """
+        if self.lazy:
+            return template.render(values)
+        key  = tuple(values.values())
+        last = self.fragments.get(template)
+        if last is not None and last[0] == key:
+            return last[1]
+        fragment = template.render(values)
+        self.fragments[template] = (key, fragment)
+        return fragment
+
     @classmethod
     def get_keyword(self):
         raise NotImplementedError("please implement!")
@@ -27,18 +58,49 @@ class BookElement(object):
                 raise InvalidBookElementError
 
     @classmethod
-    def factory(cls, base_path, options, object_str, init_data):
+    def _read(cls, path, cache=None):
+        """Read the element file and validate it against cls.default. Returns
+        the data with missing keys filled in and the keys in cls.lazy set to
+        None. If a cache is given, unchanged files are not read again.
+        """
+        entry = cache.get(cls.get_keyword(), path) if cache else None
+        if entry is None:
+            stat = cache.stat(path) if cache else None
+            init_data = cls._eval_file(path)
+            data = cls.default.copy()
+            data.update(init_data)
+            for key in cls.lazy:
+                data[key] = None
+            entry = {"data":    data,
+                     "missing": sorted(cls.default.keys() - init_data.keys()),
+                     "unused":  sorted(init_data.keys() - cls.default.keys()),
+                     "stat":    stat}
+            if cache:
+                cache.put(cls.get_keyword(), path, entry)
+
+        if entry["missing"] or entry["unused"]:
+            logging.warning("Malformed input: " + str(path))
+        if entry["missing"]:
+            logging.warning("Missing keys: " + str(set(entry["missing"])))
+        if entry["unused"]:
+            logging.warning("Unused keys: " + str(set(entry["unused"])))
+        return dict(entry["data"])
+
+    @classmethod
+    def factory(cls, base_path, options, object_str, init_data, cache=None):
         for e in BookElement.__subclasses__():
             if e.get_keyword() == object_str:
-                return e(base_path, options, init_data)
+                element = e(base_path, options, init_data, cache)
+                element.source = (object_str, init_data)
+                return element
         raise InvalidBookElementError("keyword not found")
 
 class Chapter(BookElement):
-    str_template = r"""
+    str_template = Template(r"""
         \ltchapter{{{chapter_name}}}
-    """
+    """)
 
-    def __init__(self, base_path, options, init_data):
+    def __init__(self, base_path, options, init_data, cache=None):
         self.text = init_data
         super().__init__()
 
@@ -49,22 +111,35 @@ class Chapter(BookElement):
     def get_keyword(self):
         return "chapter"
 
-    def generate(self):
-        return self.str_template.format(chapter_name=self.text)
+    def generate(self, options=None):
+        return self.render(self.str_template, chapter_name=self.text)
 
 
 class Song(BookElement):
     # TODO: this should not be two templates. But the trailing % of the songheader is kind of annoying...
-    str_template = r"""
+    str_template = Template(r"""
         \songheader{{{title}}}{{{artist}}}{{{album}}}{{{tuning}}}{{{composer}}}
-        \lilypondfile{{{path}}}
-    """
+        {score}
+    """, escaped=["title", "artist", "album", "tuning", "composer"])
     
-    str_midi_template = r"""
+    str_midi_template = Template(r"""
         \songheader{{{title}}}{{{artist}}}{{{album}}}{{{tuning}}}{{{composer}}}%
         \marginpar{{\attachfile[mimetype=audio/midi, print=false]{{{midi_file}}}}}
-        \lilypondfile{{{path}}}
-    """
+        {score}
+    """, escaped=["title", "artist", "album", "tuning", "composer"])
+
+    str_draft_template = Template(r"""
+        \songheader{{{title}}}{{{artist}}}{{{album}}}{{{tuning}}}{{{composer}}}
+        \songplaceholder{{{tg_file}}}
+    """, escaped=["title", "artist", "album", "tuning", "composer", "tg_file"])
+
+    # settings for the lilypond engine, like lilypond-book would use them
+    paper_settings_name = "limetusk-paper-{paper}.ly"
+    paper_settings = r"""\paper {{
+  indent = 0\mm
+  line-width = {line_width}\mm
+}}
+"""
 
     default = {"artist": "",
                "title": "",
@@ -73,50 +148,65 @@ class Song(BookElement):
                "composer": "",
                "tg_file": ""}
 
-    def __init__(self, base_path, options, init_path):
-        init_data = BookElement._eval_file(os.path.join(base_path, init_path))
-        self.options = options
-        
-        missing_keys = Song.default.keys() - init_data.keys()
-        unused_keys  = init_data.keys() - Song.default.keys()
-        if missing_keys or unused_keys:
-            logging.warning("Malformed input: " + str(init_path))
-        if missing_keys:
-            logging.warning("Missing keys: " + str(missing_keys))
-        if unused_keys:
-            logging.warning("Unused keys: " + str(unused_keys))
-        
-        self.data = Song.default.copy()
-        self.data.update(init_data)
+    def __init__(self, base_path, options, init_path, cache=None):
+        self.init_path = os.path.join(base_path, init_path)
+        self.data      = Song._read(self.init_path, cache)
+        self.options   = options
         self.data["tg_file"] = os.path.join(base_path, self.data["tg_file"])
         if not os.path.exists(self.data["tg_file"]):
             raise FileNotFoundError
+        self.midi_failed   = False
+        self.render_failed = False
         super().__init__()
 
     def __str__(self):
         return "Song: {}".format(self.data["title"])
 
+    def files(self):
+        return [self.init_path, self.data["tg_file"]]
+
     @classmethod
     def get_keyword(self):
         return "song"
 
-    def generate(self):
-        self.data["hash"] = self.convert()
-        if self.options.midi:
+    def generate(self, options=None):
+        options = options or self.options
+        if options.draft:
+            return self.render(self.str_draft_template, artist   = self.data["artist"],
+                                                        title    = self.data["title"],
+                                                        tuning   = self.data["tuning"],
+                                                        album    = self.data["album"],
+                                                        composer = self.data["composer"],
+                                                        tg_file  = os.path.basename(self.data["tg_file"]))
+        if "hash" not in self.data:
+            self.data["hash"] = self.convert()
+        if self.data["hash"] is None:
+            return ""
+        if options.midi and not self.midi_failed and not self.midi_up_to_date():
             self.generate_midi()
+        rel_path = os.path.join(self.options.out_path, self.data["hash"])
+        if options.engine == "lilypond":
+            if not self.render_failed and not self.systems_up_to_date(options.paper):
+                Song.write_paper_settings(self.options.out_path, options.paper)
+                self.render_systems(options.paper)
+            if self.render_failed:
+                return ""
+            score = "\\input{" + self.systems_path(options.paper) + "-systems.tex}"
+        else:
+            score = "\\lilypondfile{" + rel_path + ".ly}"
 
-        if self.options.midi:
+        if options.midi and not self.midi_failed:
             template = self.str_midi_template
         else:
             template = self.str_template
     
-        return template.format(artist    = escape_latex(self.data["artist"]),
-                                title     = escape_latex(self.data["title"]),
-                                tuning    = escape_latex(self.data["tuning"]),
-                                album     = escape_latex(self.data["album"]),
-                                composer  = escape_latex(self.data["composer"]),
-                                midi_file = os.path.join(self.options.out_path, self.data["hash"] + ".midi"),
-                                path      = os.path.join(self.options.out_path, self.data["hash"] + ".ly"))
+        return self.render(template, artist    = self.data["artist"],
+                                     title     = self.data["title"],
+                                     tuning    = self.data["tuning"],
+                                     album     = self.data["album"],
+                                     composer  = self.data["composer"],
+                                     midi_file = rel_path + ".midi",
+                                     score     = score)
 
 
     def generate_midi(self):
@@ -134,18 +224,93 @@ class Song(BookElement):
         cmd  = ["lilypond"]
         cmd += [] if not self.options.verbose < 2 else ["--loglevel=NONE"]
         cmd += ["-o", rel_path, m_ly_path]
-        out = subprocess.check_output(cmd)
-        os.remove(m_ly_path)
+        with tracer.span(os.path.basename(self.init_path), "midi") as trace_args:
+            try:
+                out = limetusk.trace.check_output(cmd)
+            finally:
+                os.remove(m_ly_path)
+            trace_args["output_size"] = os.path.getsize(rel_path + ".midi")
 
-    def convert(self):
-        cmd = ["java", "-jar", limetusk.util.TG2LY_BIN, "--in", self.data["tg_file"], "--out", self.options.out_path]
-        out = subprocess.check_output(cmd)
-        out = out.decode('utf-8').replace('\n', '')
+    @classmethod
+    def paper_settings_path(cls, out_path, paper):
+        return os.path.join(out_path, cls.paper_settings_name.format(paper=paper))
+
+    @classmethod
+    def write_paper_settings(cls, out_path, paper):
+        """Write the settings file included by render_systems() for the
+        paper size, unless it is up to date. The systems get the width of the
+        text area. Returns the path of the file.
+        """
+        path = cls.paper_settings_path(out_path, paper)
+        text = cls.paper_settings.format(line_width=limetusk.util.TEXT_AREA_MM[paper][0])
+        limetusk.util.write_if_changed(path, text)
+        return path
+
+    def systems_path(self, paper):
+        """Path of the rendered systems for the paper size, without the
+        "-systems.tex" or "-<n>.pdf" suffix.
+        """
+        return os.path.join(self.options.out_path, "{hash}-{paper}".format(hash=self.data["hash"], paper=paper))
+
+    def render_systems(self, paper):
+        r"""Render the .ly file with lilypond into one pdf per system and a
+        <hash>-<paper>-systems.tex including them, like lilypond-book does
+        for \lilypondfile, but with predictable names.
+        """
+        rel_path = os.path.join(self.options.out_path, self.data["hash"])
+        cmd  = ["lilypond"]
+        cmd += [] if not self.options.verbose < 2 else ["--loglevel=NONE"]
+        cmd += ["-dbackend=eps", "-dno-gs-load-fonts", "-dinclude-eps-fonts", "--pdf"]
+        cmd += ["-dinclude-settings=" + Song.paper_settings_path(self.options.out_path, paper)]
+        cmd += ["-o", self.systems_path(paper), rel_path + ".ly"]
+        with tracer.span(os.path.basename(self.init_path), "render", paper=paper) as trace_args:
+            limetusk.trace.check_output(cmd)
+            trace_args["output_size"] = os.path.getsize(self.systems_path(paper) + "-systems.tex")
+
+    def systems_up_to_date(self, paper):
+        """True, if the systems of the song for the paper size are newer than
+        the .ly file and the paper settings.
+        """
+        rel_path = os.path.join(self.options.out_path, self.data["hash"])
+        try:
+            return os.path.getmtime(self.systems_path(paper) + "-systems.tex") >= \
+                max(os.path.getmtime(rel_path + ".ly"),
+                    os.path.getmtime(Song.paper_settings_path(self.options.out_path, paper)))
+        except OSError:
+            return False
+
+    def copy_state(self, other):
+        """Take over the results of preparing other, a song with the same
+        .tg file.
+        """
+        self.data["hash"]  = other.data.get("hash")
+        self.midi_failed   = other.midi_failed
+        self.render_failed = other.render_failed
+
+    def midi_up_to_date(self):
+        """True, if the .midi file exists and is not older than the .ly file."""
+        rel_path = os.path.join(self.options.out_path, self.data["hash"])
+        try:
+            return os.path.getmtime(rel_path + ".midi") >= os.path.getmtime(rel_path + ".ly")
+        except OSError:
+            return False
+
+    def convert(self, force=False):
+        """Convert the .tg file with tg2ly and return its hash. Unless force
+        is set, tg2ly skips files older than their .ly file.
+        """
+        cmd  = ["java", "-jar", limetusk.util.TG2LY_BIN]
+        cmd += ["--force"] if force else []
+        cmd += ["--in", self.data["tg_file"], "--out", self.options.out_path]
+        with tracer.span(os.path.basename(self.init_path), "convert", tg_file=self.data["tg_file"]) as trace_args:
+            out = limetusk.trace.check_output(cmd)
+            out = out.decode('utf-8').replace('\n', '')
+            trace_args["output_size"] = os.path.getsize(os.path.join(self.options.out_path, out + ".ly"))
         return out
 
 
 class CSong(BookElement):
-    str_template = r"""
+    str_template = Template(r"""
         \csongtoc{{{title}}}{{{artist}}}
         \beginsong{{{title}}}[
           by={{{artist}}},
@@ -155,7 +320,7 @@ class CSong(BookElement):
         
             {content}
         \endsong
-    """
+    """, escaped=["title", "artist", "tuning", "composer"])
     
     default = {"artist": "",
                "title": "",
@@ -165,25 +330,20 @@ class CSong(BookElement):
                "year": "",
                "content": ""}
 
-    def __init__(self, base_path, options, init_path):
-        init_data = BookElement._eval_file(os.path.join(base_path, init_path))
-        
-        missing_keys = CSong.default.keys() - init_data.keys()
-        unused_keys  = init_data.keys() - CSong.default.keys()
-        if missing_keys or unused_keys:
-            logging.warning("Malformed input: " + str(init_path))
-        if missing_keys:
-            logging.warning("Missing keys: " + str(missing_keys))
-        if unused_keys:
-            logging.warning("Unused keys: " + str(unused_keys))
-        
-        self.data = CSong.default.copy()
-        self.data.update(init_data)
+    # chord sheets can be large
+    lazy = ["content"]
+
+    def __init__(self, base_path, options, init_path, cache=None):
+        self.init_path = os.path.join(base_path, init_path)
+        self.data      = CSong._read(self.init_path, cache)
         super().__init__()
 
     def __str__(self):
         return "CSong: {}".format(self.data["title"])
 
+    def files(self):
+        return [self.init_path]
+
     @classmethod
     def get_keyword(self):
         return "csong"
@@ -198,75 +358,65 @@ class CSong(BookElement):
         return r"""\end{songs}
                 """
 
-    def generate(self):
-        return self.str_template.format(artist   = escape_latex(self.data["artist"]),
-                                         title    = escape_latex(self.data["title"]),
-                                         tuning   = escape_latex(self.data["tuning"]),
-                                         composer = escape_latex(self.data["composer"]),
-                                         content  = self.data["content"])
+    def generate(self, options=None):
+        return self.render(self.str_template, artist   = self.data["artist"],
+                                              title    = self.data["title"],
+                                              tuning   = self.data["tuning"],
+                                              composer = self.data["composer"],
+                                              content  = self.load_content())
+
+    def load_content(self):
+        return BookElement._eval_file(self.init_path).get("content", CSong.default["content"])
 
 
 class Quote(BookElement):
-    str_template = r"""
+    str_template = Template(r"""
         \fquote{{{text}}}{{{source}}}
-    """
+    """)
     
     default = {"text": "",
                "source": ""}
 
-    def __init__(self, base_path, options, init_path):
-        init_data = BookElement._eval_file(os.path.join(base_path, init_path))
-        
-        missing_keys = Quote.default.keys() - init_data.keys()
-        unused_keys  = init_data.keys() - Quote.default.keys()
-        if missing_keys or unused_keys:
-            logging.warning("Malformed input: " + str(init_path))
-        if missing_keys:
-            logging.warning("Missing keys: " + str(missing_keys))
-        if unused_keys:
-            logging.warning("Unused keys: " + str(unused_keys))
-        
-        self.data = Quote.default.copy()
-        self.data.update(init_data)
+    lazy = ["text"]
+
+    def __init__(self, base_path, options, init_path, cache=None):
+        self.init_path = os.path.join(base_path, init_path)
+        self.data      = Quote._read(self.init_path, cache)
         super().__init__()
 
     def __str__(self):
         return "Quote: {}".format(self.data["source"])
 
+    def files(self):
+        return [self.init_path]
+
     @classmethod
     def get_keyword(self):
         return "quote"
 
-    def generate(self):
-        return self.str_template.format(text=self.data["text"], source=self.data["source"])
+    def generate(self, options=None):
+        return self.render(self.str_template, text=self.load_text(), source=self.data["source"])
+
+    def load_text(self):
+        return BookElement._eval_file(self.init_path).get("text", Quote.default["text"])
 
 
 class Picture(BookElement):
-    str_template = r"""
+    str_template = Template(r"""
         \begin{{figure}}[htb]
         {align}
         \includegraphics[{size}]{{{path}}}
         \end{{figure}}
-    """
+    """)
 
     default = {"align": "",
                "size": "",
                "pic_path": ""}
 
-    def __init__(self, base_path, options, init_path):
-        init_data = BookElement._eval_file(os.path.join(base_path, init_path))
-        
-        missing_keys = Picture.default.keys() - init_data.keys()
-        unused_keys  = init_data.keys() - Picture.default.keys()
-        if missing_keys or unused_keys:
-            logging.warning("Malformed input: " + str(init_path))
-        if missing_keys:
-            logging.warning("Missing keys: " + str(missing_keys))
-        if unused_keys:
-            logging.warning("Unused keys: " + str(unused_keys))
-        
-        self.data = Picture.default.copy()
-        self.data.update(init_data)
+    def __init__(self, base_path, options, init_path, cache=None):
+        self.init_path = os.path.join(base_path, init_path)
+        self.data      = Picture._read(self.init_path, cache)
+        self.options   = options
         
         if self.data["align"] == "center":
             self.data["align"] = "\\centering"
@@ -276,21 +426,44 @@ class Picture(BookElement):
             self.data["align"] = "\\raggedright"
         self.data["pic_path"] = os.path.join(base_path, self.data["pic_path"])
         self.data["pic_path"] = os.path.abspath(self.data["pic_path"])
+        # downsampled copy of the picture, see downsample()
+        self.image_path = None
         super().__init__()
 
     def __str__(self):
         return "Picture: {}".format(self.data["pic_path"])
 
+    def files(self):
+        return [self.init_path, self.data["pic_path"]]
+
     @classmethod
     def get_keyword(self):
         return "pic"
 
-    def generate(self):
-        return Picture.str_template.format(align=self.data["align"], size=self.data["size"], path=self.data["pic_path"])
+    def generate(self, options=None):
+        size = self.data["size"]
+        if (options or self.options).draft:
+            # only the bounding box of the picture is read
+            size = "draft, " + size if size else "draft"
+        return self.render(Picture.str_template, align=self.data["align"], size=size, path=self.graphic_path())
+
+    def graphic_path(self):
+        """The file included in the document."""
+        return self.image_path or self.data["pic_path"]
+
+    def downsample(self):
+        """Downsample the picture to the resolution given by --dpi. Returns
+        the path of the downsampled copy, or None if the original is used.
+        """
+        out_path = os.path.abspath(os.path.join(self.options.out_path, "images"))
+        with tracer.span(os.path.basename(self.init_path), "image", pic_path=self.data["pic_path"]) as trace_args:
+            ret = limetusk.images.downsample(self.data["pic_path"], out_path, self.data["size"], self.options.dpi)
+            trace_args["output_size"] = os.path.getsize(ret or self.data["pic_path"])
+        return ret
 
 
 class Title(BookElement):
-    def __init__(self, base_path, options, init_data):
+    def __init__(self, base_path, options, init_data, cache=None):
         self.title = init_data
         super().__init__()
 
@@ -301,5 +474,26 @@ class Title(BookElement):
     def get_keyword(self):
         return "title"
 
-    def generate(self):
+    def generate(self, options=None):
+        return ""
+
+
+class Omitted(BookElement):
+    """Stands for elements left out of a subset build, see Subset. Generates
+    nothing, but ends a songs environment like the elements it replaces.
+    """
+    def __init__(self):
+        # not created from a line of the book
+        self.source = None
+        super().__init__()
+
+    def __str__(self):
+        return "Omitted"
+
+    @classmethod
+    def get_keyword(self):
+        # can't be used in a book
+        return None
+
+    def generate(self, options=None):
         return ""
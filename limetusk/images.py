@@ -0,0 +1,86 @@
+import logging
+import os
+import re
+import limetusk.util
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# in inches
+TEXT_WIDTH  = limetusk.util.TEXT_WIDTH_MM / 25.4
+TEXT_HEIGHT = limetusk.util.TEXT_HEIGHT_MM / 25.4
+
+UNITS = {"in": 1.0,
+         "cm": 1 / 2.54,
+         "mm": 1 / 25.4,
+         "pt": 1 / 72.27,
+         "bp": 1 / 72.0}
+
+LENGTHS = {"\\textwidth":  TEXT_WIDTH,
+           "\\linewidth":  TEXT_WIDTH,
+           "\\textheight": TEXT_HEIGHT}
+
+# vector formats pdflatex includes, which Pillow can't downsample
+VECTOR_EXTENSIONS = {".pdf", ".eps", ".ps", ".svg"}
+
+size_re = re.compile(r"(width|height)\s*=\s*([0-9]*\.?[0-9]+)?\s*(\\[a-z]+|[a-z]{2})")
+
+
+def target_size(size, dpi):
+    """Maximum width and height in pixels for the \\includegraphics options
+    in size. Either can be None, if size doesn't limit it. Returns None, if
+    size doesn't contain an absolute width or height, e.g. a scale.
+    """
+    ret = {}
+    for dimension, factor, unit in size_re.findall(size):
+        length = LENGTHS.get(unit, UNITS.get(unit))
+        if length is None:
+            continue
+        ret[dimension] = int(round(float(factor or 1) * length * dpi))
+    if not ret:
+        return None
+    return ret.get("width"), ret.get("height")
+
+
+def downsample(src_path, out_path, size, dpi):
+    """Downsample the image at src_path to dpi for the given size options.
+    Returns the path of the downsampled image, which is cached in out_path
+    by content hash, target size and format. Returns None, if the image is
+    used as it is, because it is small enough or can't be handled.
+    """
+    target = target_size(size, dpi)
+    if target is None or os.path.splitext(src_path)[1].lower() in VECTOR_EXTENSIONS:
+        return None
+    try:
+        img = Image.open(src_path)
+    except Image.UnidentifiedImageError:
+        logging.debug("Not a raster image, using {src} as it is.".format(src=src_path))
+        return None
+    with img:
+        width, height = img.size
+        scale = min(target[0] / width if target[0] else 1.0,
+                    target[1] / height if target[1] else 1.0)
+        if scale >= 1.0:
+            return None
+        new_size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+        photo    = img.format == "JPEG"
+        ext      = ".jpg" if photo else ".png"
+        dst_path = os.path.join(out_path, "{hash}-{width}x{height}{ext}".format(
+            hash=limetusk.util.file_hash(src_path), width=new_size[0], height=new_size[1], ext=ext))
+        if os.path.exists(dst_path):
+            return dst_path
+
+        if img.mode not in (["L", "RGB", "CMYK"] if photo else ["L", "LA", "RGB", "RGBA"]):
+            img = img.convert("RGBA" if not photo and ("A" in img.getbands() or "transparency" in img.info) else "RGB")
+        img = img.resize(new_size, Image.LANCZOS)
+        os.makedirs(out_path, exist_ok=True)
+        tmp_path = dst_path + ".tmp"
+        if photo:
+            img.save(tmp_path, "JPEG", quality=85, optimize=True, dpi=(dpi, dpi))
+        else:
+            img.save(tmp_path, "PNG", optimize=True, dpi=(dpi, dpi))
+        os.replace(tmp_path, dst_path)
+    logging.debug("Downsampled {src} from {old} to {new} pixels.".format(src=src_path, old=(width, height), new=new_size))
+    return dst_path
@@ -0,0 +1,48 @@
+import json
+import logging
+import os
+import limetusk.util
+
+
+class BuildManifest(object):
+    """Records the inputs and outputs of every build stage in the output
+    directory. A stage only needs to run again, if its inputs changed or one
+    of its outputs is missing or was modified since it was recorded.
+    """
+    file_name = ".limetusk_manifest.json"
+
+    def __init__(self, out_path):
+        self.manifest_path = os.path.join(out_path, self.file_name)
+        try:
+            with open(self.manifest_path, "r") as fd:
+                self.stages = json.load(fd)
+        except FileNotFoundError:
+            self.stages = {}
+        except ValueError:
+            logging.warning("Build manifest corrupt, ignoring it: " + self.manifest_path)
+            self.stages = {}
+
+    def save(self):
+        limetusk.util.write_json(self.manifest_path, self.stages)
+
+    @staticmethod
+    def _output_hashes(outputs):
+        ret = {}
+        for path in outputs:
+            ret[path] = limetusk.util.file_hash(path) if os.path.exists(path) else None
+        return ret
+
+    def up_to_date(self, stage, inputs, outputs):
+        record = self.stages.get(stage)
+        if record is None or record["inputs"] != inputs:
+            return False
+        current = self._output_hashes(outputs)
+        return None not in current.values() and current == record["outputs"]
+
+    def update(self, stage, inputs, outputs):
+        self.stages[stage] = {"inputs": inputs, "outputs": self._output_hashes(outputs)}
+        self.save()
+
+    def invalidate(self, stage):
+        if self.stages.pop(stage, None) is not None:
+            self.save()
@@ -0,0 +1,29 @@
+import string
+from limetusk.util import escape_latex
+
+
+class Template(object):
+    """A lytex template of a book element in str.format syntax. The template
+    is parsed once when it is created: its fields are known up front and the
+    fields in escaped are escaped for LaTeX on render(), all others are
+    inserted as they are.
+    """
+
+    def __init__(self, text, escaped=()):
+        self.text    = text
+        self.fields  = tuple(dict.fromkeys(name for _, name, _, _ in string.Formatter().parse(text) if name))
+        unknown = set(escaped) - set(self.fields)
+        if unknown:
+            raise ValueError("Escaped fields not in template: " + ", ".join(sorted(unknown)))
+        self.escaped = tuple(name for name in self.fields if name in escaped)
+        self._format = text.format_map
+
+    def __str__(self):
+        return self.text
+
+    def render(self, values):
+        """The template filled with values, a dict with every field."""
+        values = dict(values)
+        for name in self.escaped:
+            values[name] = escape_latex(values[name])
+        return self._format(values)
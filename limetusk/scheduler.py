@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def physical_memory():
+    """Physical memory in MiB, or None if unknown."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") >> 20
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class DependencyFailedError(Exception):
+    pass
+
+
+class Task(object):
+    def __init__(self, name, func, deps, resources):
+        self.name      = name
+        self.func      = func
+        self.deps      = deps
+        self.resources = resources
+        self.future    = None
+
+    def __str__(self):
+        return self.name
+
+
+class Scheduler(object):
+    """Runs a graph of tasks. A task starts as soon as all tasks it depends
+    on finished successfully, its blocking function runs in a thread. Every
+    task declares the resources it needs, e.g. {"jvm": 1, "memory": 256},
+    and only as many tasks run at the same time as the limits allow. A task
+    needing more than a limit runs once it has the resource to itself.
+    Tasks can be added while the scheduler runs, also from other threads.
+    A task whose dependency failed fails with DependencyFailedError. Task
+    functions are expected to handle their errors, other exceptions are
+    logged.
+    """
+
+    def __init__(self, limits):
+        self.limits  = limits
+        self.tasks   = []
+        self.lock    = threading.Lock()
+        self.loop    = None
+        self.running = {}
+
+    def add(self, name, func, deps=(), resources=None):
+        task = Task(name, func, list(deps), resources or {})
+        with self.lock:
+            self.tasks.append(task)
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self._start, task)
+        return task
+
+    def run(self, func=None):
+        """Run func in a thread while the tasks are scheduled, e.g. to add
+        tasks as soon as they are known. Returns the failed tasks, when func
+        and all tasks finished.
+        """
+        asyncio.run(self._main(func))
+        failed = [task for task in self.tasks if task.future.exception() is not None]
+        for task in failed:
+            if not isinstance(task.future.exception(), DependencyFailedError):
+                logging.error("Task {name} failed: {error!r}".format(name=task.name, error=task.future.exception()))
+        return failed
+
+    async def _main(self, func):
+        self.running   = {resource: 0 for resource in self.limits}
+        self.condition = asyncio.Condition()
+        workers = sum(limit for resource, limit in self.limits.items() if resource != "memory") + 1
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        with self.executor:
+            with self.lock:
+                self.loop = asyncio.get_running_loop()
+                for task in self.tasks:
+                    self._start(task)
+            try:
+                if func is not None:
+                    await self.loop.run_in_executor(self.executor, func)
+                while True:
+                    with self.lock:
+                        started = all(task.future is not None for task in self.tasks)
+                        pending = [task.future for task in self.tasks if task.future and not task.future.done()]
+                    if pending:
+                        await asyncio.wait(pending)
+                    elif started:
+                        break
+                    else:
+                        # tasks added from other threads start with the next iteration of the loop
+                        await asyncio.sleep(0)
+            finally:
+                with self.lock:
+                    self.loop = None
+
+    def _start(self, task):
+        task.future = self.loop.create_task(self._run(task))
+
+    def _amount(self, resource, amount):
+        return min(amount, self.limits[resource])
+
+    def _available(self, resources):
+        return all(self.running[r] + self._amount(r, n) <= self.limits[r] for r, n in resources.items())
+
+    async def _run(self, task):
+        for dep in task.deps:
+            try:
+                await dep.future
+            except Exception:
+                raise DependencyFailedError(dep.name)
+        resources = {r: n for r, n in task.resources.items() if r in self.limits}
+        async with self.condition:
+            await self.condition.wait_for(lambda: self._available(resources))
+            for r, n in resources.items():
+                self.running[r] += self._amount(r, n)
+        try:
+            return await self.loop.run_in_executor(self.executor, task.func)
+        finally:
+            async with self.condition:
+                for r, n in resources.items():
+                    self.running[r] -= self._amount(r, n)
+                self.condition.notify_all()
@@ -0,0 +1,299 @@
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import limetusk.util
+from limetusk.book import Book
+from limetusk.tg2ly import Tg2lyWorkerPool
+from limetusk.trace import tracer
+from limetusk.watch import BookWatcher
+
+
+def default_socket_path():
+    runtime_path = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+    return os.path.join(runtime_path, "limetusk-{uid}.sock".format(uid=os.getuid()))
+
+
+class BuildJob(object):
+    """A build requested by one or more clients with the same arguments."""
+
+    def __init__(self, key, cwd, args):
+        self.key     = key
+        self.cwd     = cwd
+        self.args    = args
+        self.clients = []
+        self.lock    = threading.Lock()
+        self.done    = threading.Event()
+
+    def send(self, **message):
+        """Send message to all clients, clients that went away are dropped."""
+        line = (json.dumps(message) + "\n").encode("utf-8")
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.sendall(line)
+                except OSError:
+                    self.clients.remove(client)
+
+
+class ForwardHandler(logging.Handler):
+    """Streams the log records of a build to the clients of its job."""
+
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        self.setFormatter(logging.Formatter("%(message)s"))
+
+    def emit(self, record):
+        self.job.send(event="log", level=record.levelname, message=self.format(record))
+
+
+class BuildQueue(object):
+    """Builds waiting for the worker. Every book has its own queue and the
+    books take turns, so a book rebuilt on every keystroke doesn't starve
+    the others. A request equal to a queued one joins it instead of
+    queueing another build.
+    """
+
+    def __init__(self):
+        self.books     = collections.OrderedDict()
+        self.condition = threading.Condition()
+
+    def put(self, book_key, key, cwd, args, client):
+        """Queue the build and add client to it. Returns the job and the
+        number of builds queued before it.
+        """
+        with self.condition:
+            jobs = self.books.setdefault(book_key, collections.deque())
+            job = next((j for j in jobs if j.key == key), None)
+            if job is None:
+                job = BuildJob(key, cwd, args)
+                jobs.append(job)
+                self.condition.notify()
+            with job.lock:
+                job.clients.append(client)
+            position = sum(len(j) for j in self.books.values()) - 1
+        return job, position
+
+    def get(self):
+        """Block until a build is queued and return it."""
+        with self.condition:
+            while not self.books:
+                self.condition.wait()
+            book_key, jobs = next(iter(self.books.items()))
+            job = jobs.popleft()
+            del self.books[book_key]
+            if jobs:
+                # the book goes to the end of the line
+                self.books[book_key] = jobs
+            return job
+
+
+class BuildServer(object):
+    """Builds books on request of LimeTusk.py client over a Unix socket.
+    The toolchain state and the parsed books with their element caches stay
+    in memory between builds, a book built again is only reloaded where its
+    files changed. Songs are converted by tg2ly workers kept running between
+    builds, so the JVM startup is paid once. Builds run one at a time, since
+    a build already uses all jobs, in the order of the BuildQueue.
+
+    The protocol is one JSON object per line. The client sends
+    {"cwd": ..., "args": [...]} with the arguments of a LimeTusk.py build and
+    gets {"event": "queued"|"started"|"log", ...} messages while the build
+    runs and {"event": "finished", "ok": ...} at the end.
+    """
+
+    def __init__(self, socket_path, parse_options, create_builder, max_books=8, max_workers=2):
+        self.socket_path    = socket_path
+        self.parse_options  = parse_options
+        self.create_builder = create_builder
+        self.max_books      = max_books
+        self.queue          = BuildQueue()
+        self.max_workers    = max_workers
+        self.workers        = Tg2lyWorkerPool()
+        # (cwd, args) -> book, builder and the snapshot of its files
+        self.books          = collections.OrderedDict()
+
+    def run(self):
+        if os.path.exists(self.socket_path):
+            if self.listening(self.socket_path):
+                raise FileExistsError("A build server is already listening on " + self.socket_path)
+            os.remove(self.socket_path)
+        limetusk.util.check_env()
+        server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.handle(self.request, self.rfile)
+
+        # stop like on Ctrl+C, so the socket is removed
+        signal.signal(signal.SIGTERM, self.terminate)
+        worker = threading.Thread(target=self.work, daemon=True)
+        worker.start()
+        with socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler) as unix_server:
+            unix_server.daemon_threads = True
+            logging.info("Build server listening on {path}, press Ctrl+C to stop...".format(path=self.socket_path))
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                os.remove(self.socket_path)
+                self.workers.close()
+
+    @staticmethod
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    @staticmethod
+    def listening(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except OSError:
+                return False
+        return True
+
+    def handle(self, connection, rfile):
+        try:
+            request = json.loads(rfile.readline().decode("utf-8"))
+            cwd, args = request["cwd"], list(request["args"])
+        except (ValueError, KeyError, TypeError):
+            connection.sendall(b'{"event": "finished", "ok": false, "message": "Invalid request."}\n')
+            return
+        key = (cwd, tuple(args))
+        job, position = self.queue.put(self.book_key(cwd, args), key, cwd, args, connection)
+        if position:
+            job.send(event="queued", position=position)
+        job.done.wait()
+
+    @staticmethod
+    def book_key(cwd, args):
+        for i, arg in enumerate(args):
+            if arg == "--in" and i + 1 < len(args):
+                return os.path.join(cwd, args[i + 1])
+            if arg.startswith("--in="):
+                return os.path.join(cwd, arg[len("--in="):])
+        return None
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.send(event="started")
+            handler = ForwardHandler(job)
+            logging.getLogger().addHandler(handler)
+            try:
+                ok, message = self.build(job)
+            except Exception as e:
+                logging.exception("Build failed")
+                ok, message = False, "Build failed: {error}".format(error=e)
+            finally:
+                logging.getLogger().removeHandler(handler)
+            job.send(event="finished", ok=ok, message=message)
+            job.done.set()
+
+    def options(self, job):
+        """Parse the arguments of the job, paths are relative to the working
+        directory of the client. Returns None and the error message for
+        invalid arguments.
+        """
+        stderr = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(stderr):
+                options = self.parse_options(job.args)
+        except SystemExit:
+            return None, stderr.getvalue().strip()
+        for o in [options] + options.variants:
+            for attr in ["in_path", "out_path", "trace", "cache_dir"]:
+                if getattr(o, attr):
+                    setattr(o, attr, os.path.join(job.cwd, getattr(o, attr)))
+        if options.watch:
+            logging.warning("--watch is ignored by the build server.")
+        return options, None
+
+    def build(self, job):
+        """Build the book of the job. Returns whether it succeeded and a
+        message for the client.
+        """
+        options, error = self.options(job)
+        if options is None:
+            return False, error
+        run_time = time.time()
+        state = self.books.pop(job.key, None)
+        try:
+            # cheap: the tools are only probed again if one of them changed
+            limetusk.util.tool_info.cache_clear()
+            limetusk.util.check_env(options.recheck_env)
+            if state is None:
+                # parsed up front, so its files are known before the build
+                book = Book(options.in_path, options)
+                builder = self.create_builder(book, options)
+                builder.workers = self.workers
+        except FileNotFoundError as e:
+            return False, str(e)
+        if options.trace:
+            tracer.reset()
+            tracer.enabled = True
+
+        current = None
+        if state is not None:
+            book, builder, snapshot = state
+            current = BookWatcher(book, builder).snapshot()
+            changed = {path for path in current.keys() | snapshot.keys() if current.get(path) != snapshot.get(path)}
+            if changed:
+                logging.info("Changed: " + ", ".join(sorted(changed)))
+                book.reload(changed)
+        # taken before the build, so files saved during it are reloaded next time
+        snapshot = BookWatcher(book, builder).snapshot(current)
+        try:
+            ok = builder.build()
+        finally:
+            self.workers.trim(self.max_workers)
+        self.books[job.key] = (book, builder, snapshot)
+        while len(self.books) > self.max_books:
+            self.books.popitem(last=False)
+
+        if options.trace:
+            tracer.write(options.trace)
+            logging.info(tracer.summary())
+            tracer.enabled = False
+        if not ok:
+            return False, "Build failed after {run_time:.2f} seconds".format(run_time=time.time() - run_time)
+        return True, "Finished in {run_time:.2f} seconds".format(run_time=time.time() - run_time)
+
+
+def request_build(socket_path, args, out=sys.stderr):
+    """Send a build request with args to the build server and print its
+    progress to out like a local build would. Returns whether the build
+    succeeded.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            raise ConnectionError("No build server listening on {path}, start one with 'LimeTusk.py serve'.".format(
+                path=socket_path))
+        sock.sendall((json.dumps({"cwd": os.getcwd(), "args": args}) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as fd:
+            for line in fd:
+                message = json.loads(line)
+                if message["event"] == "log":
+                    print("{level}:{message}".format(**message), file=out)
+                elif message["event"] == "queued":
+                    print("INFO:Queued behind {position} builds.".format(**message), file=out)
+                elif message["event"] == "finished":
+                    if message.get("message"):
+                        print(("INFO:" if message["ok"] else "ERROR:") + message["message"], file=out)
+                    return message["ok"]
+    print("ERROR:The build server closed the connection.", file=out)
+    return False
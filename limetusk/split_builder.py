@@ -0,0 +1,165 @@
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import limetusk.util
+from limetusk.book import Book
+from limetusk.book_builder import BookBuilder
+
+try:
+    from pypdf import PdfWriter
+    from pypdf.errors import PyPdfError
+except ImportError:
+    PdfWriter = None
+
+
+class SplitBookBuilder(BookBuilder):
+    """Compile the book in parts, which are merged into the final pdf.
+    The first part holds the title, the table of contents and everything
+    before the first chapter, every chapter is a part of its own. The parts
+    are compiled in parallel rounds: each part starts with the counters
+    (page, section, ...) the previous parts end with, and the front part gets
+    the table of contents of all other parts. Rounds are repeated until no
+    part's inputs change anymore. Unchanged parts reuse their previous pdf.
+    """
+    state_re = re.compile(r"\\setcounter\{([^}]*)\}\{(-?\d+)\}")
+
+    @staticmethod
+    def check_env():
+        if PdfWriter is None:
+            raise FileNotFoundError("pypdf not found! It is needed to merge the parts in split mode.")
+
+    def build(self):
+        self.prepare()
+
+        logging.info("Generating book parts...")
+        parts = self.book.split_chapters()
+        names = [self.part_name(i) for i in range(len(parts))]
+        for i, (name, content) in enumerate(zip(names, parts)):
+            self.generate_lytex(name, content, self.part_header(i), self.tex_path(name) if self.direct_tex() else None)
+
+        logging.info("Compiling book parts...")
+        # copy sty first, since lilypond-book tries to guess the textwidth
+        shutil.copy(limetusk.util.LIMETUSK_STY, self.options.out_path)
+        ok = True
+        if not self.direct_tex():
+            # lilypond-book runs one part after the other, since parts share the snippet directories
+            for name, content in zip(names, parts):
+                ok = self.run_stage("lilypond-book:" + name, self.lilypond_book_inputs(name, content),
+                                    [self.tex_path(name)], lambda: self.generate_tex(name)) and ok
+        if not self.compile_parts(names, parts):
+            logging.error("Compiling the book parts failed.")
+            return False
+        part_pdfs = [self.pdflatex_outputs(name)[0] for name in names]
+        return self.run_stage("merge", self._hash_files(part_pdfs), self.pdflatex_outputs(),
+                              lambda: self.merge_parts(part_pdfs)) and ok
+
+    def part_name(self, index):
+        return "{title}-{index:02d}".format(title=self.book.title, index=index)
+
+    def part_header(self, index):
+        header = Book.lytex_preamble_template.format(title=self.book.title, paper=self.options.paper)
+        if index == 0:
+            return header + "        \\LTsplitfront\n" + Book.lytex_front
+        return header + "        \\LTsplitpart\n"
+
+    def _rel_path(self, name, ext):
+        return os.path.join(self.options.out_path, name + ext)
+
+    def read_state(self, name, ext):
+        try:
+            with open(self._rel_path(name, ext), "r") as fd:
+                return {counter: int(value) for counter, value in self.state_re.findall(fd.read())}
+        except FileNotFoundError:
+            return {}
+
+    def update_start_states(self, names):
+        """Write the counters every part starts with to its .ltin file. They
+        are the start counters of the previous part plus the amount the
+        previous part increased them by, the last time it was compiled.
+        """
+        start = {}
+        for i, name in enumerate(names):
+            # the .lts was written by the last compile, which started with
+            # the .ltin as it is before it is updated
+            given = self.read_state(name, ".ltin") if i > 0 else {}
+            end   = self.read_state(name, ".lts")
+            if i > 0:
+                text = "".join("\\setcounter{{{counter}}}{{{value}}}\n".format(counter=counter, value=value)
+                               for counter, value in sorted(start.items()))
+                limetusk.util.write_if_changed(self._rel_path(name, ".ltin"), text)
+            for counter, value in end.items():
+                default = 1 if counter == "page" else 0
+                start[counter] = start.get(counter, default) + value - given.get(counter, default)
+
+    def merged_toc(self, names):
+        ret = ""
+        for name in names[1:]:
+            try:
+                with open(self._rel_path(name, ".toc"), "r") as fd:
+                    ret += fd.read()
+            except FileNotFoundError:
+                pass
+        return ret
+
+    def part_inputs(self, name, content, toc):
+        inputs = self.pdflatex_inputs(name, content)
+        inputs["state"] = self._hash_files([self._rel_path(name, ".ltin")])
+        inputs["aux"]   = self._hash_files([self._rel_path(name, ".aux")])
+        if toc is not None:
+            inputs["toc"] = toc
+        return inputs
+
+    def compile_parts(self, names, parts):
+        rounds = 0
+        while True:
+            self.update_start_states(names)
+            toc = self.merged_toc(names)
+            stale = []
+            for i, (name, content) in enumerate(zip(names, parts)):
+                inputs = self.part_inputs(name, content, toc if i == 0 else None)
+                if not self.manifest.up_to_date("pdflatex:" + name, inputs, self.pdflatex_outputs(name)):
+                    stale.append((name, inputs))
+            if not stale:
+                break
+            if rounds >= self.options.max_passes:
+                logging.warning("Book parts still changing after {rounds} rounds.".format(rounds=rounds))
+                break
+            logging.debug("Round {no}: compiling {parts}".format(no=rounds + 1, parts=", ".join(name for name, _ in stale)))
+            if stale[0][0] == names[0]:
+                # pdflatex overwrites the toc of the front part with its own entries
+                with open(self._rel_path(names[0], ".toc"), "w") as fd:
+                    fd.write(toc)
+            with ThreadPoolExecutor(max_workers=self.options.jobs) as pool:
+                results = list(pool.map(lambda name: self.compile_tex(name=name),
+                                        [name for name, _ in stale]))
+            for (name, inputs), ok in zip(stale, results):
+                if not ok:
+                    self.manifest.invalidate("pdflatex:" + name)
+                    return False
+                self.manifest.update("pdflatex:" + name, inputs, self.pdflatex_outputs(name))
+            rounds += 1
+        return True
+
+    def merge_parts(self, part_pdfs):
+        """Merge the pdfs of the parts into the book. A part pypdf can't read
+        is logged and the merge fails.
+        """
+        writer = PdfWriter()
+        path   = None
+        try:
+            for path in part_pdfs[1:]:
+                writer.append(path, import_outline=True)
+            # the front part is inserted last: its table of contents links to
+            # named destinations in the other parts, which pypdf only keeps if
+            # they are already known
+            path = part_pdfs[0]
+            writer.merge(0, path, import_outline=True)
+            path = self.pdflatex_outputs()[0]
+            with open(path, "wb") as fd:
+                writer.write(fd)
+        except (PyPdfError, OSError, ValueError) as e:
+            logging.error("Merging {path} failed: {error}".format(path=path, error=e))
+            return False
+        return True
@@ -0,0 +1,90 @@
+import fnmatch
+import logging
+from limetusk.elements import BookElement, Chapter, CSong, Song, Title, Omitted
+
+
+class Subset(object):
+    """Selects part of the book content for --only. A filter is one of
+        chapter:PATTERN   elements of the chapters whose title matches
+        KEYWORD           elements of this kind, e.g. song, csong, quote or pic
+        title:PATTERN     songs and chord sheets whose title matches
+        PATTERN           same as title:PATTERN
+    Patterns are case insensitive shell patterns, a pattern without wildcards
+    matches any title containing it. Filters of the same kind are combined
+    with or, different kinds with and, e.g. "--only chapter:Rock --only csong"
+    selects the chord sheets of the Rock chapter.
+    """
+
+    def __init__(self, filters):
+        self.chapters = []
+        self.keywords = []
+        self.titles   = []
+        keywords = [e.get_keyword() for e in BookElement.__subclasses__() if e not in [Chapter, Title, Omitted]]
+        for f in filters:
+            kind, _, pattern = f.partition(":")
+            if kind == "chapter" and pattern:
+                self.chapters.append(self._pattern(pattern))
+            elif kind == "title" and pattern:
+                self.titles.append(self._pattern(pattern))
+            elif f in keywords:
+                self.keywords.append(f)
+            else:
+                self.titles.append(self._pattern(f))
+
+    @staticmethod
+    def _pattern(pattern):
+        pattern = pattern.lower()
+        if not any(c in pattern for c in "*?["):
+            pattern = "*" + pattern + "*"
+        return pattern
+
+    @staticmethod
+    def _matches(text, patterns):
+        return any(fnmatch.fnmatchcase(text.lower(), p) for p in patterns)
+
+    def wanted(self, e, chapter):
+        """True, if the element e in the chapter with the given title is
+        selected.
+        """
+        if self.chapters and not self._matches(chapter, self.chapters):
+            return False
+        if self.keywords and e.get_keyword() not in self.keywords:
+            return False
+        if self.titles:
+            return isinstance(e, (Song, CSong)) and self._matches(e.data["title"], self.titles)
+        return True
+
+    def select(self, content):
+        """The selected elements in book order. Titles are always kept, as
+        are the chapters of selected elements and chapters selected by name,
+        so the structure of the book stays the same. Chord sheets that were
+        in separate songs environments stay separated by an Omitted element.
+        """
+        ret          = []
+        chapter      = ""
+        chapter_elem = None
+        gap          = False
+        for e in content:
+            if isinstance(e, Title):
+                ret.append(e)
+            elif isinstance(e, Chapter):
+                chapter      = e.text
+                chapter_elem = e
+                gap          = True
+                if self.chapters and self._matches(chapter, self.chapters):
+                    ret.append(e)
+                    chapter_elem = None
+            elif self.wanted(e, chapter):
+                if chapter_elem is not None:
+                    ret.append(chapter_elem)
+                    chapter_elem = None
+                if gap and isinstance(e, CSong) and ret and isinstance(ret[-1], CSong):
+                    ret.append(Omitted())
+                ret.append(e)
+                gap = False
+            elif not isinstance(e, CSong):
+                gap = True
+        logging.info("Building {selected} of {total} elements.".format(
+            selected=sum(1 for e in ret if not isinstance(e, (Title, Chapter, Omitted))),
+            total=sum(1 for e in content if not isinstance(e, (Title, Chapter)))))
+        return ret
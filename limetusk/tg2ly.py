@@ -0,0 +1,128 @@
+import logging
+import os
+import subprocess
+import threading
+import limetusk.util
+from limetusk.trace import tracer
+
+
+class Tg2lyError(OSError):
+    """A file tg2ly couldn't convert, like a failing tg2ly process."""
+    pass
+
+
+def worker_cmd():
+    return ["java", "-cp", limetusk.util.TG2LY_BIN, limetusk.util.TG2LY_WORKER_SRC]
+
+
+class Tg2lyWorker(object):
+    """A JVM running bin/Tg2lyWorker.java, which converts .tg files by
+    calling tg2ly's LyExport.export() one after the other. The JVM is started
+    on the first convert() and again after it died. It is thread safe, but
+    converts one file at a time.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with tracer.span("tg2ly worker", "convert"):
+            self.proc = subprocess.Popen(worker_cmd(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         encoding="utf-8")
+            if self.proc.stdout.readline() != "ready\n":
+                self.close()
+                raise Tg2lyError("tg2ly worker failed to start")
+        logging.debug("Started tg2ly worker {pid}".format(pid=self.proc.pid))
+
+    def convert(self, tg_file, out_path, force=False):
+        """Convert tg_file into out_path and return its hash. Unless force is
+        set, tg2ly skips files older than their .ly file. Raises Tg2lyError,
+        if tg2ly failed.
+        """
+        if "\n" in tg_file + out_path or "\t" in tg_file + out_path:
+            raise Tg2lyError("Unsupported path: " + tg_file)
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            with tracer.span(os.path.basename(tg_file), "convert", tg_file=tg_file, worker=True) as trace_args:
+                try:
+                    self.proc.stdin.write("\t".join([out_path, tg_file, "force" if force else ""]) + "\n")
+                    self.proc.stdin.flush()
+                    reply = self.proc.stdout.readline()
+                except OSError:
+                    reply = ""
+                if not reply:
+                    self.close()
+                    raise Tg2lyError("tg2ly worker exited")
+                status, _, value = reply.rstrip("\n").partition("\t")
+                if status != "ok" or not value:
+                    raise Tg2lyError(value or "tg2ly printed no hash")
+                trace_args["output_size"] = os.path.getsize(os.path.join(out_path, value + ".ly"))
+        return value
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+
+class Tg2lyWorkerPool(object):
+    """Tg2lyWorkers kept running, so a conversion doesn't pay the JVM
+    startup. convert() takes an idle worker or starts another one, so there
+    are as many workers as conversions run at the same time, which the
+    scheduler limits to the jvm slots. Workers stay idle until trim() or
+    close(), e.g. the build server keeps a few of them between builds. All
+    workers are restarted when tg2ly or the worker changed.
+    """
+
+    def __init__(self):
+        self.lock  = threading.Lock()
+        self.idle  = []
+        self.stamp = None
+
+    @staticmethod
+    def _stamp():
+        ret = []
+        for path in [limetusk.util.TG2LY_BIN, limetusk.util.TG2LY_WORKER_SRC]:
+            try:
+                stat = os.stat(path)
+                ret.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                ret.append(None)
+        return ret
+
+    def convert(self, tg_file, out_path, force=False):
+        """Like Tg2lyWorker.convert()."""
+        stamp = self._stamp()
+        with self.lock:
+            if stamp != self.stamp:
+                self._trim(0)
+                self.stamp = stamp
+            worker = self.idle.pop() if self.idle else Tg2lyWorker()
+        try:
+            return worker.convert(tg_file, out_path, force)
+        finally:
+            with self.lock:
+                if worker.proc is not None and stamp == self.stamp:
+                    self.idle.append(worker)
+                    worker = None
+            if worker is not None:
+                worker.close()
+
+    def _trim(self, max_idle):
+        while len(self.idle) > max_idle:
+            self.idle.pop(0).close()
+
+    def trim(self, max_idle):
+        """Close idle workers until at most max_idle are left."""
+        with self.lock:
+            self._trim(max_idle)
+
+    def close(self):
+        self.trim(0)
@@ -0,0 +1,115 @@
+import contextlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+
+class Tracer(object):
+    """Records spans of the build (parsing, every element, every external
+    process) with their wall time, the CPU time of the calling thread and of
+    the processes started with run(), exit codes and output sizes. Disabled
+    by default, then span() only costs a function call.
+    The spans can be written in the Chrome trace event format, which can be
+    opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events  = []
+        self.lock    = threading.Lock()
+        self.local   = threading.local()
+        self.origin  = time.perf_counter()
+
+    def reset(self):
+        """Drop all recorded spans and start the time line again."""
+        with self.lock:
+            self.events = []
+            self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Trace the enclosed block. The yielded dict can be filled with
+        additional information like output sizes.
+        """
+        if not self.enabled:
+            yield args
+            return
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(args)
+        start     = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield args
+        except subprocess.CalledProcessError as e:
+            args["exit_code"] = e.returncode
+            raise
+        except Exception as e:
+            args["error"] = str(e)
+            raise
+        finally:
+            args["cpu_time"] = time.thread_time() - cpu_start + args.get("process_cpu_time", 0.0)
+            stack.pop()
+            event = {"name": name,
+                     "cat":  category,
+                     "ph":   "X",
+                     "ts":   (start - self.origin) * 1e6,
+                     "dur":  (time.perf_counter() - start) * 1e6,
+                     "pid":  os.getpid(),
+                     "tid":  threading.get_native_id(),
+                     "args": args}
+            with self.lock:
+                self.events.append(event)
+
+    def annotate(self, **kwargs):
+        """Add information to the innermost span of the current thread."""
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1].update(kwargs)
+
+    def write(self, path):
+        with open(path, "w") as fd:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fd)
+
+    def summary(self, limit=10):
+        """Text summary: totals per category and the slowest spans."""
+        lines = ["Trace summary:"]
+        totals = {}
+        for e in self.events:
+            count, dur, cpu = totals.get(e["cat"], (0, 0.0, 0.0))
+            totals[e["cat"]] = (count + 1, dur + e["dur"] / 1e6, cpu + e["args"].get("cpu_time", 0.0))
+        for category, (count, dur, cpu) in sorted(totals.items(), key=lambda t: -t[1][1]):
+            lines.append("  {category:14} {count:6d} spans {dur:10.3f} s wall {cpu:10.3f} s cpu".format(
+                category=category, count=count, dur=dur, cpu=cpu))
+        lines.append("Slowest spans:")
+        for e in sorted(self.events, key=lambda e: -e["dur"])[:limit]:
+            details = ", ".join("{}={}".format(k, v if not isinstance(v, float) else round(v, 3))
+                                for k, v in sorted(e["args"].items()))
+            lines.append("  {dur:10.3f} s  {category:14} {name}  ({details})".format(
+                dur=e["dur"] / 1e6, category=e["cat"], name=e["name"], details=details))
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def run(cmd, stdout=None, stderr=None, env=None):
+    """Like subprocess.run, but the exit code and the CPU time of the process
+    are added to the current span. stderr can't be captured.
+    """
+    proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env)
+    out = proc.stdout.read() if stdout == subprocess.PIPE else None
+    if proc.stdout:
+        proc.stdout.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    tracer.annotate(exit_code=proc.returncode, process_cpu_time=rusage.ru_utime + rusage.ru_stime)
+    return subprocess.CompletedProcess(cmd, proc.returncode, out)
+
+
+def check_output(cmd, env=None):
+    """Like subprocess.check_output, but traced like run()."""
+    proc = run(cmd, stdout=subprocess.PIPE, env=env)
+    proc.check_returncode()
+    return proc.stdout
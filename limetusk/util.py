@@ -1,51 +1,174 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
 import subprocess
 
 LIMETUSK_STY = "bin/limetusk.sty"
 TG2LY_BIN = "bin/tg2ly_0_3_1.jar"
+# launcher running tg2ly in one JVM for many files, see limetusk.tg2ly
+TG2LY_WORKER_SRC = "bin/Tg2lyWorker.java"
+
+# width and height in mm of the type area of the DIV=15 layout of the book
+# for every supported paper size
+TEXT_AREA_MM = {"a4": (168.0, 237.6),
+                "a5": (118.4, 168.0)}
+# pictures are downsampled for the largest type area
+TEXT_WIDTH_MM, TEXT_HEIGHT_MM = TEXT_AREA_MM["a4"]
+
+
+# Borrowed from PyLaTeX (MIT license). Thanks.
+# https://github.com/JelteF/PyLaTeX/blob/master/pylatex/utils.py
+LATEX_SPECIAL_CHARS = {
+    '&':  r'\&',
+    '%':  r'\%',
+    '$':  r'\$',
+    '#':  r'\#',
+    '_':  r'\_',
+    '{':  r'\{',
+    '}':  r'\}',
+    '~':  r'\textasciitilde{}',
+    '^':  r'\^{}',
+    '\\': r'\textbackslash{}',
+    '\n': r'\\',
+    '-':  r'{-}',
+    '\xA0': '~',  # Non-breaking space
+}
+_latex_special_re = re.compile("[" + re.escape("".join(LATEX_SPECIAL_CHARS)) + "]")
+
+
+def _escape_match(match):
+    return LATEX_SPECIAL_CHARS[match.group()]
 
 
 def escape_latex(s):
-    """Borrowed from PyLaTeX (MIT license). Thanks.
-       https://github.com/JelteF/PyLaTeX/blob/master/pylatex/utils.py
+    """Escape the special characters of LaTeX in s. Most values contain
+    none, they are returned as they are after a single scan.
+    """
+    if _latex_special_re.search(s) is None:
+        return s
+    return _latex_special_re.sub(_escape_match, s)
+
+
+def file_hash(path):
+    """SHA-1 of the file's content."""
+    h = hashlib.sha1()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_if_changed(path, text):
+    """Write text to the file, unless it already holds it, so its mtime
+    only changes with its content.
     """
-    _latex_special_chars = {
-        '&':  r'\&',
-        '%':  r'\%',
-        '$':  r'\$',
-        '#':  r'\#',
-        '_':  r'\_',
-        '{':  r'\{',
-        '}':  r'\}',
-        '~':  r'\textasciitilde{}',
-        '^':  r'\^{}',
-        '\\': r'\textbackslash{}',
-        '\n': r'\\',
-        '-':  r'{-}',
-        '\xA0': '~',  # Non-breaking space
-    }    
-    return ''.join(_latex_special_chars.get(c, c) for c in s)
-
-
-def check_env():
-    cmd  = ["lilypond-book", "--version"]
-    try:
-        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise FileNotFoundError("lilypond-book not found!")
-    cmd  = ["lilypond", "--version"]
-    try:
-        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except FileNotFoundError:
-        raise FileNotFoundError("lilypond not found!")
-    cmd  = ["pdflatex", "--version"]
     try:
-        subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(path, "r") as fd:
+            if fd.read() == text:
+                return
     except FileNotFoundError:
-        raise FileNotFoundError("pdflatex not found!")
-    cmd = ["java", "-jar", TG2LY_BIN, "--version"]
+        pass
+    with open(path, "w") as fd:
+        fd.write(text)
+
+
+def write_json(path, data):
+    """Write data as JSON to the file. It is written to a temporary file
+    first and renamed, so readers never see a partial file.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fd:
+        json.dump(data, fd, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def tg2ly_worker_available():
+    """True, if java can run bin/Tg2lyWorker.java with the tg2ly jar, which
+    needs java 11 or newer. The worker converts many files in one JVM, see
+    limetusk.tg2ly.
+    """
+    return tool_info()["tg2ly"]["worker"]
+
+
+ENV_STATE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "limetusk", "env.json")
+
+# name, version command, additional files the tool depends on
+TOOLS = [("lilypond-book", ["lilypond-book", "--version"],               []),
+         ("lilypond",      ["lilypond", "--version"],                    []),
+         ("pdflatex",      ["pdflatex", "--version"],                    []),
+         ("tg2ly",         ["java", "-jar", TG2LY_BIN, "--version"],     [TG2LY_BIN, TG2LY_WORKER_SRC])]
+
+
+def _tool_stat(name, cmd, files):
+    """Resolved paths, mtimes and sizes of a tool's binary and files."""
+    exe = shutil.which(cmd[0])
+    if exe is None:
+        raise FileNotFoundError("{} not found!".format(cmd[0]))
+    ret = []
+    for path in [os.path.realpath(exe)] + [os.path.abspath(f) for f in files]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise FileNotFoundError("{} not found!".format(name))
+        ret.append([path, st.st_mtime_ns, st.st_size])
+    return ret
+
+
+def _probe_tool(name, cmd):
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if proc.returncode != 0 and name == "tg2ly":
+        raise FileNotFoundError("tg2ly not found!")
+    out = proc.stdout.decode('utf-8', 'replace').strip().splitlines()
+    info = {"version": out[0] if out else ""}
+    if name == "tg2ly":
+        # the version string alone doesn't change for self built jars
+        info["version"] += " ({})".format(file_hash(TG2LY_BIN))
+        # the worker prints "ready" when started and exits at the end of stdin
+        proc = subprocess.run(["java", "-cp", TG2LY_BIN, TG2LY_WORKER_SRC], stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        info["worker"] = proc.returncode == 0 and proc.stdout.decode('utf-8', 'replace').startswith("ready")
+    return info
+
+
+@functools.lru_cache(maxsize=None)
+def tool_info(recheck=False):
+    """Return version information of every external tool. Probing a tool
+    means starting it, which is slow for tg2ly. So the results are kept in a
+    state file together with the resolved paths, mtimes and sizes of the
+    tools, and a tool is only probed again if one of them changed or recheck
+    is set. Raises FileNotFoundError if one of the tools is missing.
+    """
     try:
-        ret = subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if ret != 0:
-            raise FileNotFoundError("tg2ly not found!")
-    except FileNotFoundError:
-        raise FileNotFoundError("java not found!")
+        with open(ENV_STATE_PATH, "r") as fd:
+            state = json.load(fd)
+    except (OSError, ValueError):
+        state = {}
+    changed = False
+    for name, cmd, files in TOOLS:
+        stat  = _tool_stat(name, cmd, files)
+        entry = state.get(name)
+        if recheck or entry is None or entry.get("stat") != stat:
+            logging.debug("Probing " + name)
+            entry = {"stat": stat, "info": _probe_tool(name, cmd)}
+            state[name] = entry
+            changed = True
+    if changed:
+        try:
+            os.makedirs(os.path.dirname(ENV_STATE_PATH), exist_ok=True)
+            write_json(ENV_STATE_PATH, state)
+        except OSError as e:
+            logging.warning("Could not save toolchain state: {error}".format(error=e))
+    return {name: state[name]["info"] for name, _, _ in TOOLS}
+
+
+def tool_versions():
+    """Return the version string of every external tool."""
+    return {name: info["version"] for name, info in tool_info().items()}
+
+
+def check_env(recheck=False):
+    tool_info(recheck)
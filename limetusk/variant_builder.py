@@ -0,0 +1,69 @@
+import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import limetusk.util
+from limetusk.book_builder import BookBuilder
+
+
+class VariantBookBuilder(BookBuilder):
+    """Build several variants of the book in one run, e.g. a print edition
+    with midi files and a draft proof. The book is parsed and its songs are
+    converted and rendered once for all variants. Every variant gets its own
+    document, named after the book title and the variant, which is compiled
+    by pdflatex in parallel to the others.
+    """
+
+    def build(self):
+        self.prepare()
+
+        builders = [(self.variant_name(options), self.variant_builder(options)) for options in self.options.variants]
+        logging.info("Generating variants...")
+        for name, builder in builders:
+            builder.generate_lytex(name, path=builder.tex_path(name) if builder.direct_tex() else None)
+
+        logging.info("Compiling variants...")
+        # copy sty first, since lilypond-book tries to guess the textwidth
+        shutil.copy(limetusk.util.LIMETUSK_STY, self.options.out_path)
+        ok = True
+        for name, builder in builders:
+            if not builder.direct_tex():
+                # lilypond-book runs one variant after the other, since variants share the snippet directories
+                ok = self.run_stage("lilypond-book:" + name, builder.lilypond_book_inputs(name),
+                                    [builder.tex_path(name)], lambda: builder.generate_tex(name)) and ok
+        if not self.compile_variants(builders):
+            logging.error("Compiling the variants failed.")
+            return False
+        return ok
+
+    def variant_name(self, options):
+        return "{title}-{name}".format(title=self.book.title, name=options.name)
+
+    def variant_builder(self, options):
+        """A builder with the options of the variant, sharing the prepared
+        book and the manifest.
+        """
+        ret = BookBuilder(self.book, options)
+        ret.manifest = self.manifest
+        return ret
+
+    def compile_variants(self, builders):
+        """Run pdflatex for all variants whose inputs changed in parallel. The
+        manifest is only updated from this thread.
+        """
+        stale = []
+        for name, builder in builders:
+            inputs = builder.pdflatex_inputs(name)
+            if self.manifest.up_to_date("pdflatex:" + name, inputs, builder.pdflatex_outputs(name)):
+                logging.info("Skipping pdflatex of {name}, nothing changed.".format(name=name))
+            else:
+                stale.append((name, builder, inputs))
+        with ThreadPoolExecutor(max_workers=self.options.jobs) as pool:
+            results = list(pool.map(lambda t: t[1].compile_passes(t[0]), stale))
+        ret = True
+        for (name, builder, inputs), ok in zip(stale, results):
+            if ok:
+                self.manifest.update("pdflatex:" + name, inputs, builder.pdflatex_outputs(name))
+            else:
+                self.manifest.invalidate("pdflatex:" + name)
+                ret = False
+        return ret
@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+
+class BookWatcher(object):
+    """Rebuild a book whenever the book file or one of the files referenced
+    by its elements changes. Changes are detected by comparing mtime and size
+    of all watched files. If watchdog is installed, its file system events
+    wake the watcher up early, otherwise it simply polls every interval
+    seconds. Rapid saves are collected until nothing changed for debounce
+    seconds.
+    """
+
+    def __init__(self, book, builder, interval=1.0, debounce=0.5):
+        self.book     = book
+        self.builder  = builder
+        self.interval = interval
+        self.debounce = debounce
+        self.wakeup   = threading.Event()
+        self.observer = None
+        self.watched_dirs = set()
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def snapshot(self, known=None):
+        """mtime and size of every file of the book. Files in the snapshot
+        known keep the state they have there, e.g. from before the book was
+        reloaded, so changes since then are not lost.
+        """
+        known = known or {}
+        return {path: known[path] if path in known else self._stat(path) for path in self.book.files()}
+
+    def _start_observer(self):
+        if Observer is None:
+            logging.debug("watchdog not installed, polling for changes.")
+            return
+        self.observer = Observer()
+        self.observer.start()
+        self._watch_dirs()
+
+    def _watch_dirs(self):
+        if self.observer is None:
+            return
+        watcher = self
+
+        class WakeupHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher.wakeup.set()
+
+        for path in self.book.files():
+            path = os.path.dirname(os.path.abspath(path))
+            if path not in self.watched_dirs and os.path.isdir(path):
+                self.observer.schedule(WakeupHandler(), path)
+                self.watched_dirs.add(path)
+
+    def wait_for_changes(self, last):
+        """Block until watched files changed and settled. Returns the new
+        snapshot and the set of changed paths.
+        """
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            current = self.snapshot()
+            if current != last:
+                break
+        # debounce: wait until the files stopped changing
+        while True:
+            time.sleep(self.debounce)
+            settled = self.snapshot()
+            if settled == current:
+                break
+            current = settled
+        changed = {path for path in current.keys() | last.keys() if current.get(path) != last.get(path)}
+        return current, changed
+
+    def run(self):
+        self._start_observer()
+        logging.info("Watching for changes, press Ctrl+C to stop...")
+        last = self.snapshot()
+        try:
+            while True:
+                last, changed = self.wait_for_changes(last)
+                logging.info("Changed: " + ", ".join(sorted(changed)))
+                run_time = time.time()
+                try:
+                    self.book.reload(changed)
+                    # the book may reference new files now. They are taken
+                    # before the build, so saves during it trigger another one
+                    last = self.snapshot(last)
+                    self._watch_dirs()
+                    ok = self.builder.build()
+                except Exception as e:
+                    logging.error("Rebuild failed: {error}".format(error=e))
+                else:
+                    if ok:
+                        logging.info("Rebuilt in {run_time:.2f} seconds".format(run_time=(time.time() - run_time)))
+                    else:
+                        logging.error("Rebuild failed.")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from limetusk.cache import ConversionCache
+
+
+@mock.patch("limetusk.util.tool_versions", lambda: {"tg2ly": "Tg2Ly - Version test"})
+class ConversionCacheTest(unittest.TestCase):
+    song_hash = "0cc175b9c0f1b6a831c399e269772661"
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.tg_file = os.path.join(self.path, "a.tg")
+
+    def convert(self, cache, version):
+        """Write version to the .tg file and convert it like tg2ly, which
+        names the .ly file after the name of the .tg file.
+        """
+        with open(self.tg_file, "w") as fd:
+            fd.write(version)
+        if cache.get(self.tg_file):
+            return True
+        with open(os.path.join(self.path, self.song_hash + ".ly"), "w") as fd:
+            fd.write("% " + version)
+        cache.put(self.tg_file, self.song_hash)
+        return False
+
+    def test_hit(self):
+        cache = ConversionCache(self.path)
+        self.assertFalse(self.convert(cache, "V1"))
+        self.assertTrue(self.convert(cache, "V1"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_reverted_song(self):
+        cache = ConversionCache(self.path)
+        self.assertFalse(self.convert(cache, "V1"))
+        self.assertFalse(self.convert(cache, "V2"))
+        # the .ly file holds V2 now, the entry of V1 must not be used
+        self.assertFalse(self.convert(cache, "V1"))
+        self.assertTrue(self.convert(cache, "V1"))
+
+    def test_saved_entries(self):
+        cache = ConversionCache(self.path)
+        self.convert(cache, "V1")
+        cache.save()
+        self.assertEqual(ConversionCache(self.path).get(self.tg_file), self.song_hash)
+
+    def test_missing_ly_file(self):
+        cache = ConversionCache(self.path)
+        self.convert(cache, "V1")
+        os.remove(os.path.join(self.path, self.song_hash + ".ly"))
+        self.assertIsNone(cache.get(self.tg_file))
+
+    def test_old_entries(self):
+        cache = ConversionCache(self.path)
+        self.convert(cache, "V1")
+        # entries of earlier versions only held the hash
+        cache.entries = {key: entry["hash"] for key, entry in cache.entries.items()}
+        self.assertIsNone(cache.get(self.tg_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from limetusk.book import BookOptions
+from limetusk.split_builder import PdfWriter, SplitBookBuilder
+
+
+class UpdateStartStatesTest(unittest.TestCase):
+    def setUp(self):
+        self.out_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_path)
+        book          = types.SimpleNamespace(title="Book")
+        options       = BookOptions("Book.book", self.out_path)
+        self.builder  = SplitBookBuilder(book, options)
+        self.names    = ["Book-00", "Book-01", "Book-02"]
+
+    def write(self, name, ext, counters):
+        with open(os.path.join(self.out_path, name + ext), "w") as fd:
+            for counter, value in counters.items():
+                fd.write("\\setcounter{{{counter}}}{{{value}}}\n".format(counter=counter, value=value))
+
+    def test_first_build(self):
+        self.write("Book-00", ".lts", {"page": 4, "chapter": 0})
+        self.builder.update_start_states(self.names)
+        self.assertEqual(self.builder.read_state("Book-01", ".ltin"), {"page": 4, "chapter": 0})
+        # nothing is known about the second part yet
+        self.assertEqual(self.builder.read_state("Book-02", ".ltin"), {"page": 4, "chapter": 0})
+
+    def test_counters_propagate(self):
+        self.write("Book-00", ".lts",  {"page": 4, "chapter": 0})
+        self.write("Book-01", ".ltin", {"page": 4, "chapter": 0})
+        self.write("Book-01", ".lts",  {"page": 9, "chapter": 1})
+        self.builder.update_start_states(self.names)
+        self.assertEqual(self.builder.read_state("Book-02", ".ltin"), {"page": 9, "chapter": 1})
+
+    def test_shifted_part(self):
+        # the front part grew by two pages since the second part was compiled
+        self.write("Book-00", ".lts",  {"page": 6, "chapter": 0})
+        self.write("Book-01", ".ltin", {"page": 4, "chapter": 0})
+        self.write("Book-01", ".lts",  {"page": 9, "chapter": 1})
+        self.builder.update_start_states(self.names)
+        self.assertEqual(self.builder.read_state("Book-01", ".ltin"), {"page": 6, "chapter": 0})
+        # the second part still spans five pages, measured from the .ltin it was compiled with
+        self.assertEqual(self.builder.read_state("Book-02", ".ltin"), {"page": 11, "chapter": 1})
+
+    def test_unchanged_state_is_not_rewritten(self):
+        self.write("Book-00", ".lts",  {"page": 4})
+        self.write("Book-01", ".ltin", {"page": 4})
+        path = os.path.join(self.out_path, "Book-01.ltin")
+        os.utime(path, (0, 0))
+        self.builder.update_start_states(self.names[:2])
+        self.assertEqual(os.path.getmtime(path), 0)
+
+
+@unittest.skipIf(PdfWriter is None, "pypdf not installed")
+class MergePartsTest(unittest.TestCase):
+    def test_unreadable_part(self):
+        out_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out_path)
+        builder = SplitBookBuilder(types.SimpleNamespace(title="Book"), BookOptions("Book.book", out_path))
+        part_pdfs = []
+        for name in ["Book-00", "Book-01"]:
+            part_pdfs.append(os.path.join(out_path, name + ".pdf"))
+            with open(part_pdfs[-1], "w") as fd:
+                fd.write("not a pdf")
+        with self.assertLogs(level="ERROR"):
+            self.assertFalse(builder.merge_parts(part_pdfs))
+        self.assertFalse(os.path.exists(os.path.join(out_path, "Book.pdf")))
+
+
+if __name__ == "__main__":
+    unittest.main()